@@ -0,0 +1,51 @@
+"""
+バックアップファイル（最後に取得できたバス情報）の書き込み
+
+内容が変わったときだけ、かつ最短間隔を空けて書き込む。書き込みは
+一時ファイル経由の rename で行うので、読み手が書きかけのファイルを
+読むことはない。
+"""
+
+import hashlib
+import json
+import time
+from typing import Any, Dict, List
+
+from shared_snapshot import atomic_write_bytes
+
+
+class BackupWriter:
+    """変化があったときだけ、間隔を空けてバックアップを書き込む"""
+
+    def __init__(self, path: str, min_interval: float = 30.0):
+        """
+        Args:
+            path (str): バックアップファイルのパス
+            min_interval (float): 書き込みの最短間隔（秒）
+        """
+        self.path = path
+        self.min_interval = min_interval
+        self._last_digest = None
+        self._last_write = None
+
+    def write(self, buses: List[Dict[str, Any]]) -> bool:
+        """
+        必要であればバックアップを書き込む
+
+        Returns:
+            bool: 実際に書き込んだ場合は True
+        """
+        now = time.monotonic()
+        if self._last_write is not None and now - self._last_write < self.min_interval:
+            return False
+
+        # インデントなしで書き出し、ファイルサイズと書き込み量を抑える
+        data = json.dumps(buses, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha1(data).digest()
+        if digest == self._last_digest:
+            return False
+
+        atomic_write_bytes(self.path, data)
+        self._last_digest = digest
+        self._last_write = now
+        return True
@@ -0,0 +1,237 @@
+"""
+バス位置スナップショットの定期更新
+
+上流APIへの問い合わせをバックグラウンドの1スレッドに集約し、
+HTTPリクエストはメモリ上の最新スナップショットを読むだけにする。
+閲覧者の数が増えても、上流APIへのアクセス回数は一定に保たれる。
+
+直近のスナップショットは履歴として残し、クライアントが最後に見た
+バージョンからの差分（追加・移動・削除されたバスだけ）を返せるようにする。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class BusSnapshot:
+    """ある時点のバス位置情報（生成後は変更しない）"""
+    version: int
+    buses: List[Dict[str, Any]]
+    is_stale: bool
+    fetched_at: float
+    raw_buses: List[Dict[str, Any]] = field(default_factory=list, repr=False)
+
+
+EMPTY_SNAPSHOT = BusSnapshot(version=0, buses=[], is_stale=True, fetched_at=0.0)
+
+
+class SnapshotHistory:
+    """直近のスナップショットを保持し、バージョン間の差分を計算する"""
+
+    def __init__(self, max_versions: int = 20):
+        """
+        Args:
+            max_versions (int): 差分の基準として保持するバージョン数
+        """
+        self.max_versions = max_versions
+        self._buses_by_version: "OrderedDict[int, Dict[Any, Dict[str, Any]]]" = OrderedDict()
+        self._latest = EMPTY_SNAPSHOT
+        self._diff_cache: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, snapshot: BusSnapshot):
+        """新しいスナップショットを履歴に加える（同じバージョンは無視する）"""
+        with self._lock:
+            if snapshot.version in self._buses_by_version:
+                self._latest = snapshot
+                return
+            self._buses_by_version[snapshot.version] = {bus['id']: bus for bus in snapshot.buses}
+            while len(self._buses_by_version) > self.max_versions:
+                self._buses_by_version.popitem(last=False)
+            self._latest = snapshot
+            # 差分は最新版に対して計算するので、版が変わったら作り直す
+            self._diff_cache = {}
+
+    def diff_since(self, since_version: int) -> Optional[Dict[str, Any]]:
+        """
+        指定バージョンから最新版までの差分を返す
+
+        Returns:
+            dict: {'version', 'unchanged', 'changed', 'removed', 'is_stale'}
+                  指定バージョンが履歴にない場合は None（全件を返す必要がある）
+        """
+        with self._lock:
+            latest = self._latest
+            if since_version == latest.version:
+                return {'version': latest.version, 'unchanged': True, 'is_stale': latest.is_stale}
+
+            cached = self._diff_cache.get(since_version)
+            if cached is not None:
+                return cached
+
+            old = self._buses_by_version.get(since_version)
+            current = self._buses_by_version.get(latest.version)
+            if old is None or current is None:
+                return None
+
+            # 閲覧者が何人いても、同じ基準バージョンからの差分は1回だけ計算する
+            diff = {
+                'version': latest.version,
+                'unchanged': False,
+                'changed': [bus for bus_id, bus in current.items() if old.get(bus_id) != bus],
+                'removed': [bus_id for bus_id in old if bus_id not in current],
+                'is_stale': latest.is_stale
+            }
+            self._diff_cache[since_version] = diff
+            return diff
+
+
+class SnapshotPoller:
+    """一定間隔で上流APIを取得し、最新のスナップショットを保持する"""
+
+    def __init__(self,
+                 fetch_func: Callable[[], Tuple[List[Dict[str, Any]], bool]],
+                 format_func: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]],
+                 interval: float = 3.0,
+                 first_wait: float = 10.0,
+                 shared_store=None,
+                 on_fetch: Optional[Callable[[BusSnapshot], None]] = None):
+        """
+        Args:
+            fetch_func: (生のバス情報リスト, is_stale) を返す取得関数
+            format_func: 生のバス情報をAPIレスポンス用に整形する関数
+            interval (float): 更新間隔（秒）
+            first_wait (float): 初回取得の完了を待つ最大時間（秒）
+            shared_store: SharedSnapshotStore。指定するとワーカー間で取得を1プロセスに集約する
+            on_fetch: 上流APIから取得するたびに、新しいスナップショットを渡して呼ぶ関数
+                      （取得担当のプロセスだけが呼ぶので、記録などを重複なく行える）
+        """
+        self.fetch_func = fetch_func
+        self.format_func = format_func
+        self.interval = interval
+        self.first_wait = first_wait
+        self.shared_store = shared_store
+        self.on_fetch = on_fetch
+        self.history = SnapshotHistory()
+        self._snapshot = EMPTY_SNAPSHOT
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._first_done = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """更新スレッドを起動する（2回目以降の呼び出しは何もしない）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='bus-snapshot-poller', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """更新スレッドを停止する"""
+        self._stop.set()
+
+    def get_snapshot(self) -> BusSnapshot:
+        """最新のスナップショットを返す（初回のみ取得完了を待つ）"""
+        self.start()
+        if not self._first_done.is_set():
+            # 待つのは起動直後の1回だけ（取得が失敗し続けても毎回待たせない）
+            self._first_done.wait(self.first_wait)
+            self._first_done.set()
+        return self._snapshot
+
+    @property
+    def latest(self) -> BusSnapshot:
+        """今持っているスナップショットを返す（更新スレッドの起動も初回取得の待ちもしない）"""
+        return self._snapshot
+
+    def wait_for_change(self, version: Optional[int], timeout: float) -> BusSnapshot:
+        """
+        スナップショットのバージョンが version と異なるものになるまで待つ
+
+        Returns:
+            BusSnapshot: 最新のスナップショット（timeout までに変化がなければ同じ版のまま）
+        """
+        self.start()
+        with self._changed:
+            self._changed.wait_for(lambda: self._snapshot.version != version, timeout)
+            return self._snapshot
+
+    def refresh_once(self) -> BusSnapshot:
+        """上流APIから1回取得し、スナップショットを差し替える"""
+        store = self.shared_store
+        if store is not None:
+            was_leader = store.is_leader
+            if not store.try_acquire_leader():
+                # 取得担当ではないワーカーは共有ファイルを読むだけ
+                shared = store.load_if_changed()
+                if shared is not None:
+                    self._set_snapshot(shared)
+                return self._snapshot
+            if not was_leader:
+                # 前任の取得担当が書いた最新版からバージョン番号を引き継ぐ
+                shared = store.load_if_changed()
+                if shared is not None and shared.version > self._snapshot.version:
+                    self._set_snapshot(shared)
+
+        raw_buses, is_stale = self.fetch_func()
+        buses = self.format_func(raw_buses)
+        current = self._snapshot
+
+        # 内容が変わらなければバージョンは据え置き、取得時刻だけ更新する
+        if current.version and buses == current.buses and is_stale == current.is_stale:
+            version = current.version
+        elif current.version:
+            version = current.version + 1
+        else:
+            # 最初の版は現在時刻から始め、再起動後も以前の版番号と重ならないようにする
+            version = int(time.time())
+
+        snapshot = BusSnapshot(
+            version=version,
+            buses=buses,
+            is_stale=is_stale,
+            fetched_at=time.time(),
+            raw_buses=raw_buses or []
+        )
+        self._set_snapshot(snapshot)
+        if store is not None:
+            store.publish(snapshot)
+        if self.on_fetch is not None:
+            self.on_fetch(snapshot)
+        return snapshot
+
+    def _set_snapshot(self, snapshot: BusSnapshot):
+        """スナップショットを差し替え、差分計算用の履歴にも記録する"""
+        self.history.record(snapshot)
+        with self._changed:
+            changed = snapshot.version != self._snapshot.version
+            self._snapshot = snapshot
+            if changed:
+                # 配信ストリームで待っている全員を起こす
+                self._changed.notify_all()
+
+    def _run(self):
+        """固定レートで更新を繰り返す（処理時間で周期がずれないようにする）"""
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.refresh_once()
+            except Exception as e:
+                # 取得に失敗しても直前のスナップショットを配信し続ける
+                print(f"スナップショット更新エラー: {e}")
+            if self._snapshot is not EMPTY_SNAPSHOT:
+                self._first_done.set()
+
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                # 取得が周期より長引いた場合は、遅れを取り戻そうとせず次の周期に合わせる
+                next_tick = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
@@ -0,0 +1,144 @@
+"""
+buskita.com API 共通HTTPクライアント
+
+Flaskアプリと scripts/ 配下の各スクリプトが共通で使うクライアント。
+1つの requests.Session を使い回すことで、api.buskita.com への
+TCP/TLS接続を再利用（keep-alive）し、毎回のハンドシェイクを省く。
+"""
+
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import counter, histogram
+
+# 接続先（ローカルの模擬サーバーなどに向けたい場合は環境変数で上書きする）
+API_BASE_URL = os.environ.get('BUSKITA_API_BASE_URL', 'https://api.buskita.com')
+
+DEFAULT_HEADERS = {
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'ja',
+    'Content-Type': 'application/json',
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
+}
+
+# エンドポイントごとのタイムアウト（接続, 読み込み）秒
+# get-bus は台数分まとめて呼ぶので短めにし、1台の遅れが全体を引きずらないようにする
+ENDPOINT_TIMEOUTS = {
+    'get-buses': (3.05, 5),
+    'get-bus': (3.05, 3),
+}
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# 一時的な障害とみなして再試行するステータスコード
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+Timeout = Union[float, Tuple[float, float]]
+
+UPSTREAM_SECONDS = histogram(
+    'buskita_upstream_request_seconds', '上流APIの応答時間（再試行を含む）', ['endpoint']
+)
+UPSTREAM_ERRORS = counter(
+    'buskita_upstream_errors_total', '上流APIの呼び出しの失敗（通信エラーと200以外の応答）', ['endpoint']
+)
+
+
+class BuskitaClient:
+    """接続プール付きの buskita.com API クライアント"""
+
+    def __init__(self,
+                 base_url: str = API_BASE_URL,
+                 headers: Optional[Dict[str, str]] = None,
+                 pool_size: int = 10,
+                 retries: int = 2,
+                 backoff_factor: float = 0.3,
+                 timeouts: Optional[Dict[str, Timeout]] = None,
+                 retry_reads: bool = True):
+        """
+        Args:
+            base_url (str): APIのベースURL
+            headers (dict): 送信するヘッダー（省略時は DEFAULT_HEADERS）
+            pool_size (int): 同時に保持する接続数の上限
+            retries (int): 接続エラー・一時的なエラー時の再試行回数
+            backoff_factor (float): 再試行間隔の係数（0.3 → 0.3秒, 0.6秒, ...）
+            timeouts (dict): エンドポイント名 → タイムアウトの上書き
+            retry_reads (bool): False にすると接続エラーだけを再試行し、読み込みのタイムアウトや
+                                一時的なエラーの応答は再試行しない（締め切りのある呼び出し用）
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeouts = dict(ENDPOINT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+
+        # buskita のAPIは参照専用なので、POSTでも再試行してよい
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries if retry_reads else 0,
+            status=retries if retry_reads else 0,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(['GET', 'POST']),
+            raise_on_status=False
+        )
+        # pool_block=True で接続数を pool_size までに抑える（超えた分は空きを待つ）
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+        self.session = requests.Session()
+        self.session.headers.update(headers or DEFAULT_HEADERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def timeout_for(self, endpoint: str) -> Timeout:
+        """エンドポイントに対応するタイムアウトを返す"""
+        return self.timeouts.get(endpoint, DEFAULT_TIMEOUT)
+
+    def post(self, endpoint: str, payload: Dict[str, Any], timeout: Optional[Timeout] = None) -> requests.Response:
+        """
+        エンドポイントへPOSTする
+
+        Args:
+            endpoint (str): エンドポイント名（例: 'get-buses'）
+            payload (dict): リクエストボディ
+            timeout: 省略時はエンドポイントごとの既定値
+
+        Returns:
+            requests.Response: レスポンス（ステータスコードの確認は呼び出し側で行う）
+        """
+        url = f"{self.base_url}/{endpoint}"
+        with UPSTREAM_SECONDS.time(endpoint=endpoint):
+            try:
+                response = self.session.post(url, json=payload, timeout=timeout or self.timeout_for(endpoint))
+            except requests.exceptions.RequestException:
+                UPSTREAM_ERRORS.inc(endpoint=endpoint)
+                raise
+        if response.status_code != 200:
+            UPSTREAM_ERRORS.inc(endpoint=endpoint)
+        return response
+
+    def post_json(self, endpoint: str, payload: Dict[str, Any], timeout: Optional[Timeout] = None) -> Dict[str, Any]:
+        """POSTしてJSONを返す。200以外は requests.exceptions.HTTPError を送出する"""
+        response = self.post(endpoint, payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        """保持している接続をすべて閉じる"""
+        self.session.close()
+
+
+_default_client: Optional[BuskitaClient] = None
+_default_client_lock = threading.Lock()
+
+
+def get_client() -> BuskitaClient:
+    """プロセス全体で共有するクライアントを返す"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = BuskitaClient()
+        return _default_client
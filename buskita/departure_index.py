@@ -0,0 +1,126 @@
+"""
+時刻表の発車時刻インデックス
+
+路線・曜日区分ごとに発車時刻を「0時からの経過分」のソート済み配列として
+持っておき、現在時刻からの次の便・その次の便を二分探索（bisect）で求める。
+毎秒すべての便を走査する必要がなくなる。
+"""
+
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+# 時刻表は日本時間。コンテナのタイムゾーン設定に左右されないよう固定で持つ（日本に夏時間はない）
+JST = timezone(timedelta(hours=9), 'JST')
+
+# 曜日区分（timetable.json のキー）
+DAY_TYPES = ('weekdays', 'saturdays', 'holidays')
+
+
+def parse_minutes(time_str: str) -> int:
+    """'07:30' → 450 のように、0時からの経過分に変換する"""
+    hour, minute = time_str.split(':')
+    return int(hour) * 60 + int(minute)
+
+
+def day_type_for(date) -> str:
+    """日付から曜日区分を返す（日曜は holidays、土曜は saturdays）"""
+    weekday = date.weekday()
+    if weekday == 6:
+        return 'holidays'
+    if weekday == 5:
+        return 'saturdays'
+    return 'weekdays'
+
+
+class DepartureIndex:
+    """路線 × 曜日区分ごとの発車時刻インデックス"""
+
+    def __init__(self):
+        # (路線, 曜日区分) → (発車分のソート済みリスト, 同じ順の便情報リスト)
+        self._schedules: Dict[tuple, tuple] = {}
+
+    @classmethod
+    def from_timetable(cls, raw: Dict[str, Any]) -> 'DepartureIndex':
+        """timetable.json の形式（{'time': '07:30', 'is_direct': bool} のリスト）から作る"""
+        index = cls()
+        for route_id, data in raw.items():
+            for day_type, times in data.get('schedules', {}).items():
+                index.add(route_id, day_type, (
+                    {'time': item['time'], 'is_direct': item.get('is_direct', False)}
+                    for item in times if item.get('time')
+                ))
+        return index
+
+    @classmethod
+    def from_schedule_map(cls, routes: Dict[str, Dict[str, List[str]]]) -> 'DepartureIndex':
+        """{'路線名': {'平日': ['7:30', ...]}} の形式から作る"""
+        index = cls()
+        for route_name, schedules in routes.items():
+            for day_type, times in schedules.items():
+                index.add(route_name, day_type, ({'time': t} for t in times))
+        return index
+
+    def add(self, route: str, day_type: str, entries: Iterable[Dict[str, Any]]):
+        """便のリストを登録する（時刻として解釈できない便は無視する）"""
+        parsed = []
+        for entry in entries:
+            try:
+                parsed.append((parse_minutes(entry['time']), entry))
+            except (ValueError, KeyError):
+                continue
+        parsed.sort(key=lambda item: item[0])
+        self._schedules[(route, day_type)] = (
+            [minutes for minutes, _ in parsed],
+            [entry for _, entry in parsed]
+        )
+
+    def upcoming(self, route: str, day_type: str, minute_of_day: int, count: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        指定時刻より後に発車する便を早い順に返す
+
+        Args:
+            minute_of_day (int): 現在時刻（0時からの経過分）。同じ分の便は発車済みとみなす
+            count (int): 返す最大件数（None なら残り全部）
+
+        Returns:
+            List[Dict]: 便情報に 'minutes' と 'minutes_until' を加えたもの
+        """
+        schedule = self._schedules.get((route, day_type))
+        if not schedule:
+            return []
+        minutes, entries = schedule
+        start = bisect_right(minutes, minute_of_day)
+        end = len(minutes) if count is None else min(len(minutes), start + count)
+        return [
+            dict(entries[i], minutes=minutes[i], minutes_until=minutes[i] - minute_of_day)
+            for i in range(start, end)
+        ]
+
+    def last(self, route: str, day_type: str) -> Optional[Dict[str, Any]]:
+        """その日の最終便を返す"""
+        schedule = self._schedules.get((route, day_type))
+        if not schedule or not schedule[1]:
+            return None
+        return schedule[1][-1]
+
+    def lookup(self, route: str, day_type: str, now: datetime) -> Dict[str, Any]:
+        """
+        次の便・その次の便・最終便をまとめて返す
+
+        Returns:
+            dict: {'next', 'following', 'last'}。next / following には
+                  発車時刻の UNIX 時間（departs_at）も付ける
+        """
+        minute_of_day = now.hour * 60 + now.minute
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        upcoming = self.upcoming(route, day_type, minute_of_day, count=2)
+        for entry in upcoming:
+            entry['departs_at'] = int((midnight + timedelta(minutes=entry['minutes'])).timestamp())
+
+        last = self.last(route, day_type)
+        return {
+            'next': upcoming[0] if len(upcoming) > 0 else None,
+            'following': upcoming[1] if len(upcoming) > 1 else None,
+            'last': last['time'] if last else None
+        }
@@ -0,0 +1,168 @@
+"""
+buskita.com の静的な辞書データのローカルキャッシュ
+
+バス会社・ランドマーク・バス停・のりば別名の辞書は、めったに変わらないのに
+サイズが大きい。取得した応答をバージョン番号と一緒にファイルへ保存しておき、
+バージョン確認用のエンドポイント（get-ui-dictionary-version /
+get-busstops-version）の値が変わったときだけ取り直す。
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from buskita_client import BuskitaClient, get_client
+from shared_snapshot import atomic_write_bytes
+
+# 辞書名 → (エンドポイント, siteId が必要か, バージョンの種類)
+DICTIONARIES: Dict[str, Tuple[str, bool, str]] = {
+    'companies': ('get-companies-dictionary', False, 'ui'),
+    'landmarks': ('get-landmarks-dictionary', True, 'ui'),
+    'noriba_alias': ('get-noriba-alias', True, 'ui'),
+    'busstops_group': ('get-busstops-group', True, 'busstops'),
+    'busstops_grouping': ('get-busstops-grouping', True, 'busstops'),
+}
+
+# バージョンの種類 → (エンドポイント, 応答のキー)
+VERSION_ENDPOINTS: Dict[str, Tuple[str, str]] = {
+    'ui': ('get-ui-dictionary-version', 'uiDictionaryVersion'),
+    'busstops': ('get-busstops-version', 'busstopsDictionaryVersion'),
+}
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'BUSKITA_DICTIONARY_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive', 'dictionaries')
+)
+
+
+class DictionaryCache:
+    """辞書の応答をファイルに保存し、バージョンが変わったときだけ取り直す"""
+
+    def __init__(self,
+                 client: Optional[BuskitaClient] = None,
+                 cache_dir: str = DEFAULT_CACHE_DIR,
+                 site_id: int = 9,
+                 language: int = 1,
+                 check_interval: float = 60 * 60):
+        """
+        Args:
+            client (BuskitaClient): 使うクライアント（省略時はプロセス共有のもの）
+            cache_dir (str): 保存先のディレクトリ
+            site_id (int): サイトID
+            language (int): 言語設定
+            check_interval (float): バージョンを確認し直すまでの間隔（秒）
+        """
+        self.client = client or get_client()
+        self.cache_dir = cache_dir
+        self.site_id = site_id
+        self.language = language
+        self.check_interval = check_interval
+        # 辞書名 → {'version', 'response'}（ファイルから読んだもの・取得したもの）
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        # バージョンの種類 → (バージョン, 確認した時刻)
+        self._versions: Dict[str, Tuple[Any, float]] = {}
+        self._lock = threading.RLock()
+
+    def _path(self, name: str) -> str:
+        """辞書の保存先ファイル"""
+        return os.path.join(self.cache_dir, f"site{self.site_id}_lang{self.language}_{name}.json")
+
+    def load_all(self) -> Dict[str, Any]:
+        """
+        保存済みの辞書をすべてファイルから読み込む（通信はしない）
+
+        Returns:
+            dict: 辞書名 → 保存されていたバージョン（ない辞書は含めない）
+        """
+        loaded = {}
+        with self._lock:
+            for name in DICTIONARIES:
+                entry = self._load_file(name)
+                if entry is not None:
+                    self._entries[name] = entry
+                    loaded[name] = entry.get('version')
+        return loaded
+
+    def version(self, kind: str) -> Any:
+        """
+        バージョン番号を返す（確認から check_interval が過ぎていれば問い合わせ直す）
+
+        問い合わせに失敗した場合は最後に確認できた値を返す。一度も確認できていなければ
+        保存済みの辞書のバージョンを返し、それもなければ例外を送出する。
+        """
+        with self._lock:
+            cached = self._versions.get(kind)
+            if cached is not None and time.monotonic() - cached[1] < self.check_interval:
+                return cached[0]
+            endpoint, key = VERSION_ENDPOINTS[kind]
+            try:
+                value = self.client.post_json(endpoint, self._payload(True)).get(key)
+            except Exception as e:
+                if cached is None:
+                    # 一度も確認できていなければ、保存済みの辞書のバージョンを使う（オフラインでの起動時など）
+                    saved = [entry.get('version') for n, entry in self._entries.items() if DICTIONARIES[n][2] == kind]
+                    if not saved:
+                        raise
+                    cached = (saved[0], 0.0)
+                print(f"辞書バージョンの確認エラー（{endpoint}）: {e}")
+                value = cached[0]
+            self._versions[kind] = (value, time.monotonic())
+            return value
+
+    def get(self, name: str) -> Dict[str, Any]:
+        """
+        辞書の応答（エンドポイントが返すJSONそのまま）を返す
+
+        保存済みのものとバージョンが同じなら通信せずに返す。バージョンの確認や
+        取得に失敗した場合も、保存済みのものがあればそれを返す。
+        """
+        endpoint, needs_site, kind = DICTIONARIES[name]
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = self._load_file(name)
+                if entry is not None:
+                    self._entries[name] = entry
+
+            try:
+                current = self.version(kind)
+            except Exception as e:
+                if entry is not None:
+                    print(f"辞書バージョンを確認できないため保存済みの {name} を使います: {e}")
+                    return entry['response']
+                raise
+
+            if entry is not None and current is not None and entry.get('version') == current:
+                return entry['response']
+
+            try:
+                response = self.client.post_json(endpoint, self._payload(needs_site))
+            except Exception as e:
+                if entry is not None:
+                    print(f"辞書を取得できないため保存済みの {name} を使います: {e}")
+                    return entry['response']
+                raise
+            entry = {'version': current, 'response': response}
+            self._entries[name] = entry
+            data = json.dumps(entry, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            atomic_write_bytes(self._path(name), data)
+            print(f"辞書を更新しました: {name}（バージョン {current}）")
+            return response
+
+    def _payload(self, needs_site: bool) -> Dict[str, Any]:
+        """リクエストボディ"""
+        payload = {'language': self.language}
+        if needs_site:
+            payload['siteId'] = self.site_id
+        return payload
+
+    def _load_file(self, name: str) -> Optional[Dict[str, Any]]:
+        """保存済みの辞書を読む（ない・壊れている場合は None）"""
+        try:
+            with open(self._path(name), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if isinstance(entry, dict) and 'response' in entry else None
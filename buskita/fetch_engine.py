@@ -0,0 +1,192 @@
+"""
+get-buses + get-bus の並行取得エンジン
+
+一覧（get-buses）を取得したあと、各バスの詳細（get-bus）を asyncio で
+並行して取得する。詳細の取得には全体の締め切り時間を設け、間に合わなかった
+バスは一覧の情報（位置など）だけで返す。1台の応答が遅くても、全体の
+応答時間が締め切りを超えて延びることはない。
+
+詳細情報（行き先・始終点など）は運行中ほとんど変わらないので、workNo ごとに
+有効期限付きでキャッシュし、初めて見るバスと期限切れのバスだけ get-bus を呼ぶ。
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import counter, histogram
+
+DETAIL_CACHE_LOOKUPS = counter(
+    'buskita_detail_cache_lookups_total', '詳細情報キャッシュの参照回数（result=hit/miss）', ['result']
+)
+DETAIL_FANOUT_SECONDS = histogram(
+    'buskita_detail_fanout_seconds', 'キャッシュにないバスの詳細情報（get-bus）をまとめて取得した所要時間'
+)
+DETAIL_FANOUT_MISSED = counter(
+    'buskita_detail_fanout_missed_total', '締め切りまでに詳細情報が届かなかったバスの台数'
+)
+
+
+class DetailCache:
+    """workNo をキーにした有効期限付き・LRU方式の詳細情報キャッシュ"""
+
+    def __init__(self, ttl: float = 300.0, max_size: int = 500):
+        """
+        Args:
+            ttl (float): 有効期限（秒）
+            max_size (int): 保持する最大件数の下限（超えたら最も長く使われていないものから捨てる）。
+                            運行台数が多いときは ensure_capacity() で広げる
+        """
+        self.ttl = ttl
+        self.min_size = max_size
+        self.max_size = max_size
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, work_no: Any) -> Optional[Dict[str, Any]]:
+        """有効な詳細情報を返す。なければ（または期限切れなら）None"""
+        with self._lock:
+            entry = self._entries.get(work_no)
+            if entry is None:
+                DETAIL_CACHE_LOOKUPS.inc(result='miss')
+                return None
+            expires_at, detail = entry
+            if expires_at <= time.monotonic():
+                del self._entries[work_no]
+                DETAIL_CACHE_LOOKUPS.inc(result='miss')
+                return None
+            self._entries.move_to_end(work_no)
+            DETAIL_CACHE_LOOKUPS.inc(result='hit')
+            return detail
+
+    def put(self, work_no: Any, detail: Dict[str, Any]):
+        """詳細情報を登録する"""
+        with self._lock:
+            self._entries[work_no] = (time.monotonic() + self.ttl, detail)
+            self._entries.move_to_end(work_no)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def ensure_capacity(self, fleet_size: int):
+        """
+        運行台数に合わせて最大件数を決め直す（運行台数の2倍と min_size の大きい方）
+
+        毎回全台を順に参照するので、最大件数が運行台数より小さいと LRU では
+        使う前に必ず追い出され、ヒット率が 0 になる。
+        """
+        with self._lock:
+            self.max_size = max(self.min_size, 2 * fleet_size)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BusFetchEngine:
+    """バス一覧と詳細情報を締め切り付きで並行取得する"""
+
+    def __init__(self,
+                 list_func: Callable[[], List[Dict[str, Any]]],
+                 detail_func: Callable[[Any], Optional[Dict[str, Any]]],
+                 concurrency: int = 10,
+                 deadline: float = 2.5,
+                 detail_cache: Optional[DetailCache] = None):
+        """
+        Args:
+            list_func: 位置情報付きのバス一覧を返す関数（失敗時は例外を送出）
+            detail_func: workNo と timeout（締め切りまでの残り秒数）を受け取り、詳細情報（なければ None）を返す関数。
+                         締め切りを過ぎても実行中の呼び出しはスレッドを占有し続けるので、timeout を超えて待たないこと
+            concurrency (int): 同時に実行する get-bus の最大数
+            deadline (float): 詳細取得全体の締め切り（秒）
+            detail_cache (DetailCache): 指定するとキャッシュにないバスだけ詳細を取得する
+        """
+        self.list_func = list_func
+        self.detail_func = detail_func
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.detail_cache = detail_cache
+        # HTTP呼び出しはブロッキングなので、使い回しのスレッドプール上で実行する
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bus-detail')
+
+    def fetch(self) -> List[Dict[str, Any]]:
+        """一覧と詳細を取得してマージしたリストを返す（同期版）"""
+        return asyncio.run(self.fetch_async())
+
+    async def fetch_async(self) -> List[Dict[str, Any]]:
+        """一覧と詳細を取得してマージしたリストを返す"""
+        loop = asyncio.get_running_loop()
+        # 一覧は詳細用とは別のスレッドで取得し、前回の取り残しの後ろに並ばないようにする
+        buses = await loop.run_in_executor(None, self.list_func)
+        if not buses:
+            return []
+
+        details = {}
+        if self.detail_cache is not None:
+            self.detail_cache.ensure_capacity(len(buses))
+        missing = []
+        for bus in buses:
+            work_no = bus.get('workNo')
+            cached = self.detail_cache.get(work_no) if self.detail_cache is not None else None
+            if cached is not None:
+                details[work_no] = cached
+            else:
+                missing.append(work_no)
+
+        fetched = await self._fetch_details(loop, missing)
+        if self.detail_cache is not None:
+            for work_no, detail in fetched.items():
+                self.detail_cache.put(work_no, detail)
+        details.update(fetched)
+
+        merged_buses = []
+        for bus in buses:
+            detail = details.get(bus.get('workNo'))
+            if detail:
+                # 位置・乗客数・遅延など一覧側の値は毎回新しいので、詳細の古い値で上書きしない
+                merged = dict(detail)
+                merged.update(bus)
+                bus = merged
+            merged_buses.append(bus)
+        return merged_buses
+
+    async def _fetch_details(self, loop, work_nos: List[Any]) -> Dict[Any, Dict[str, Any]]:
+        """締め切りまでに届いた詳細情報だけを workNo → 詳細 の辞書で返す"""
+        deadline_at = time.monotonic() + self.deadline
+        tasks = {
+            loop.run_in_executor(self._executor, self._fetch_detail, work_no, deadline_at): work_no
+            for work_no in work_nos
+        }
+        if not tasks:
+            return {}
+
+        started = time.perf_counter()
+        done, pending = await asyncio.wait(tasks.keys(), timeout=self.deadline)
+        DETAIL_FANOUT_SECONDS.observe(time.perf_counter() - started)
+        DETAIL_FANOUT_MISSED.inc(len(pending))
+        for task in pending:
+            # まだ始まっていない呼び出しは取り消す（実行中のものはタイムアウトで終わる）
+            task.cancel()
+        if pending:
+            print(f"締め切り（{self.deadline}秒）までに {len(pending)} 台の詳細情報が届きませんでした。位置情報のみで返します。")
+
+        details = {}
+        for task in done:
+            if task.exception() is not None:
+                continue
+            detail = task.result()
+            if detail:
+                details[tasks[task]] = detail
+        return details
+
+    def _fetch_detail(self, work_no: Any, deadline_at: float) -> Optional[Dict[str, Any]]:
+        """締め切りまでの残り時間を timeout として detail_func を呼ぶ（締め切りを過ぎていれば呼ばない）"""
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            return None
+        return self.detail_func(work_no, timeout=remaining)
+
+    def shutdown(self):
+        """スレッドプールを停止する"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
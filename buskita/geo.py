@@ -0,0 +1,126 @@
+"""
+バス位置と地点（バス停・ランドマーク・キャンパス）の距離計算とジオフェンス判定
+
+スナップショット1回分の全バスについて、全地点までの距離（haversine）を
+NumPy の配列演算でまとめて計算する。円（地点＋半径）と多角形のジオフェンスの
+内外判定も同じく1回の配列演算で行うので、地点がバス停全部に増えても
+Python のループを回さずに済む。
+"""
+
+import math
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def haversine_matrix(lats1, lngs1, lats2, lngs2) -> np.ndarray:
+    """
+    2組の地点間の距離（km）を行列で返す
+
+    Args:
+        lats1, lngs1: n 個の地点の緯度・経度（度）
+        lats2, lngs2: m 個の地点の緯度・経度（度）
+
+    Returns:
+        np.ndarray: (n, m) の距離行列
+    """
+    lat1 = np.radians(np.asarray(lats1, dtype=float))[:, np.newaxis]
+    lng1 = np.radians(np.asarray(lngs1, dtype=float))[:, np.newaxis]
+    lat2 = np.radians(np.asarray(lats2, dtype=float))[np.newaxis, :]
+    lng2 = np.radians(np.asarray(lngs2, dtype=float))[np.newaxis, :]
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """
+    2点間の距離（km）
+
+    1組だけなら配列を作るより math で計算するほうが速いので、haversine_matrix は使わない。
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(max(a, 0.0), 1.0)))
+
+
+def points_in_polygon(lats, lngs, polygon: Sequence[Tuple[float, float]]) -> np.ndarray:
+    """
+    各地点が多角形の内側にあるかを返す（レイキャスティング法）
+
+    Args:
+        lats, lngs: n 個の地点の緯度・経度
+        polygon: 多角形の頂点 [(緯度, 経度), ...]（閉じていなくてよい）
+
+    Returns:
+        np.ndarray: (n,) の bool 配列
+    """
+    vertices = np.asarray(polygon, dtype=float)
+    y = np.asarray(lats, dtype=float)[:, np.newaxis]
+    x = np.asarray(lngs, dtype=float)[:, np.newaxis]
+    yi, xi = vertices[:, 0], vertices[:, 1]
+    yj, xj = np.roll(yi, 1), np.roll(xi, 1)
+
+    crosses = (yi > y) != (yj > y)
+    # 水平な辺（yi == yj）は crosses が False になるので、0 除算の結果は使われない
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_at_y = (xj - xi) * (y - yi) / (yj - yi) + xi
+    return np.count_nonzero(crosses & (x < x_at_y), axis=1) % 2 == 1
+
+
+@dataclass
+class ProximityResult:
+    """1回のスナップショットに対する判定結果（行はバス、列は地点・ジオフェンス）"""
+    distances_km: np.ndarray
+    inside_radius: np.ndarray
+    inside_polygons: Dict[str, np.ndarray] = field(default_factory=dict)
+
+    def nearest(self, bus_index: int) -> Tuple[Optional[int], Optional[float]]:
+        """バスに最も近い地点の添字と距離（km）"""
+        if self.distances_km.shape[1] == 0:
+            return None, None
+        index = int(np.argmin(self.distances_km[bus_index]))
+        return index, float(self.distances_km[bus_index, index])
+
+
+class GeofenceEngine:
+    """地点（円のジオフェンス）と多角形のジオフェンスに対して、全バスをまとめて判定する"""
+
+    def __init__(self,
+                 points: Sequence[Dict[str, Any]] = (),
+                 polygons: Optional[Dict[str, Sequence[Tuple[float, float]]]] = None,
+                 default_radius_km: float = 0.2):
+        """
+        Args:
+            points: 地点のリスト（'lat', 'lng' と任意で 'radius_km'）
+            polygons: 名前 → 多角形の頂点 [(緯度, 経度), ...]
+            default_radius_km (float): 'radius_km' がない地点の半径
+        """
+        self.points = list(points)
+        self.polygons = dict(polygons or {})
+        self._lats = np.array([p['lat'] for p in self.points], dtype=float)
+        self._lngs = np.array([p['lng'] for p in self.points], dtype=float)
+        self._radii = np.array([p.get('radius_km', default_radius_km) for p in self.points], dtype=float)
+
+    def evaluate(self, buses: Sequence[Dict[str, Any]], lat_key: str = 'lat', lng_key: str = 'lng') -> ProximityResult:
+        """
+        全バスについて、全地点までの距離とジオフェンスの内外を1回で計算する
+
+        Args:
+            buses: バス情報のリスト（緯度・経度を lat_key / lng_key に持つ）
+        """
+        lats = np.array([bus[lat_key] for bus in buses], dtype=float)
+        lngs = np.array([bus[lng_key] for bus in buses], dtype=float)
+
+        distances = haversine_matrix(lats, lngs, self._lats, self._lngs)
+        return ProximityResult(
+            distances_km=distances,
+            inside_radius=distances <= self._radii[np.newaxis, :],
+            inside_polygons={
+                name: points_in_polygon(lats, lngs, polygon) if len(buses) else np.zeros(0, dtype=bool)
+                for name, polygon in self.polygons.items()
+            }
+        )
@@ -0,0 +1,105 @@
+"""
+バス位置履歴（SQLite）の書き込み
+
+接続を1本だけ開いたまま使い回し、位置情報はためておいて
+件数か時間のしきい値で executemany により1トランザクションで書き込む。
+WALモードにしておくので、書き込み中も別の接続から読み出せる。
+"""
+
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS bus_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        work_no INTEGER,
+        latitude REAL,
+        longitude REAL,
+        speed REAL,
+        update_time TEXT,
+        recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_bus_history_work_no_recorded_at
+        ON bus_history (work_no, recorded_at);
+'''
+
+INSERT_SQL = '''
+    INSERT INTO bus_history
+    (work_no, latitude, longitude, speed, update_time, recorded_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """WALモードで接続を開く（コミットごとの fsync を減らすため synchronous=NORMAL）"""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class BusHistoryWriter:
+    """バス位置をためておき、まとめて bus_history に書き込む"""
+
+    def __init__(self, db_path: str, batch_size: int = 500, flush_interval: float = 5.0):
+        """
+        Args:
+            db_path (str): SQLiteファイルのパス
+            batch_size (int): この件数たまったら書き込む
+            flush_interval (float): 最後の書き込みからこの秒数が過ぎたら書き込む
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn = connect(db_path)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        self._pending: List[Tuple[Any, ...]] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, bus: Dict[str, Any], recorded_at: Optional[datetime] = None):
+        """バス位置を1件ためる"""
+        self.add_many([bus], recorded_at)
+
+    def add_many(self, buses: Iterable[Dict[str, Any]], recorded_at: Optional[datetime] = None):
+        """
+        1回の取得分のバス位置をまとめてためる（しきい値を超えたら書き込む）
+
+        Args:
+            buses: バス情報（workNo, lat, lng, speed, updateTime）のリスト
+            recorded_at (datetime): 記録時刻（省略時は現在時刻）。書き込みが遅れても取得時の時刻で残す
+        """
+        # CURRENT_TIMESTAMP と同じ形式（UTC）にそろえる
+        stamp = (recorded_at or datetime.now(timezone.utc)).astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        rows = [
+            (bus.get('workNo'), bus.get('lat'), bus.get('lng'), bus.get('speed'), bus.get('updateTime'), stamp)
+            for bus in buses
+        ]
+        with self._lock:
+            self._pending.extend(rows)
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def flush(self):
+        """ためているバス位置をすべて書き込む"""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        """残りを書き込んで接続を閉じる"""
+        with self._lock:
+            self._flush_locked()
+            self.conn.close()
+
+    def _flush_locked(self):
+        """ロックを持った状態で、ためた分を1トランザクションで書き込む"""
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        with self.conn:
+            self.conn.executemany(INSERT_SQL, rows)
@@ -0,0 +1,181 @@
+"""
+曜日区分（平日・土曜・日祝）の判定
+
+get-holidays で取得した祝日一覧から、1年分の曜日区分を
+「元日からの日数 → 区分番号」の表（bytearray）として前もって作っておく。
+判定は表を1回引くだけで、リクエストの処理中に上流APIを呼ぶことはない。
+祝日一覧は作成時に1回取得し（保存済みのものが1日以内なら取得せずそれを使う）、
+その後の取り直しは1日1回、バックグラウンドのスレッドで行う。
+"""
+
+import json
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from departure_index import DAY_TYPES, JST, day_type_for
+from shared_snapshot import atomic_write_bytes
+
+# 表に入れる区分番号（DAY_TYPES の添字）
+WEEKDAY, SATURDAY, HOLIDAY = range(len(DAY_TYPES))
+
+
+def parse_holiday_dates(holidays: Dict[str, Any]) -> Set[date]:
+    """
+    get-holidays の応答（会社名 → [{'date': '2025-01-01'}, ...]）から祝日の集合を作る
+
+    会社ごとに分かれているが、同じサイトの路線は同じ日に休日ダイヤになるのでまとめて扱う。
+    日付として解釈できないものは無視する。
+    """
+    dates = set()
+    for holiday_list in (holidays or {}).values():
+        for holiday in holiday_list or []:
+            value = str(holiday.get('date', ''))[:10].replace('/', '-')
+            try:
+                dates.add(date.fromisoformat(value))
+            except ValueError:
+                continue
+    return dates
+
+
+def build_year_table(year: int, holidays: Iterable[date]) -> bytearray:
+    """指定した年の曜日区分表を作る（添字は元日からの日数）"""
+    first = date(year, 1, 1)
+    days = (date(year + 1, 1, 1) - first).days
+    table = bytearray(DAY_TYPES.index(day_type_for(first + timedelta(days=i))) for i in range(days))
+    for holiday in holidays:
+        if holiday.year == year:
+            table[holiday.timetuple().tm_yday - 1] = HOLIDAY
+    return table
+
+
+class HolidayCalendar:
+    """祝日一覧をキャッシュし、日付から曜日区分を返す"""
+
+    def __init__(self,
+                 fetch_func: Callable[[], Dict[str, Any]],
+                 refresh_interval: float = 24 * 60 * 60,
+                 retry_interval: float = 10 * 60,
+                 cache_file: Optional[str] = None):
+        """
+        作成時に祝日一覧を1回取得する（保存済みのものが refresh_interval 以内なら取得しない）。
+        取得に失敗した場合は保存済みのもの（なければ曜日だけ）で判定し、retry_interval 後に再試行する。
+
+        Args:
+            fetch_func: get-holidays の 'holidays'（会社名 → 祝日リスト）を返す取得関数
+            refresh_interval (float): 祝日一覧を取り直す間隔（秒）
+            retry_interval (float): 取得に失敗したときに再試行するまでの間隔（秒）
+            cache_file (str): 取得した祝日一覧の保存先（再起動しても1日1回の取得で済むようにする）
+        """
+        self.fetch_func = fetch_func
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.cache_file = cache_file
+        self._holidays: Set[date] = set()
+        self._tables: Dict[int, bytearray] = {}
+        self._next_refresh = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+        fetched_at = self._load_cache()
+        age = time.time() - fetched_at if fetched_at is not None else None
+        if age is not None and 0 <= age < refresh_interval:
+            self._next_refresh = time.monotonic() + refresh_interval - age
+        else:
+            try:
+                self.refresh_once()
+            except Exception as e:
+                self._next_refresh = time.monotonic() + retry_interval
+                print(f"祝日一覧の取得エラー: {e}")
+
+    def day_type(self, when: Optional[datetime] = None) -> str:
+        """
+        日付の曜日区分（'weekdays' / 'saturdays' / 'holidays'）を返す
+
+        祝日一覧を一度も取得できていない場合は、曜日だけで判定する。
+        """
+        if when is None:
+            when = datetime.now(JST)
+        self._refresh_in_background_if_due()
+
+        table = self._tables.get(when.year)
+        if table is None:
+            table = self._table_for(when.year)
+        return DAY_TYPES[table[when.timetuple().tm_yday - 1]]
+
+    def refresh_once(self):
+        """祝日一覧を取得し、今年と来年の表を作り直す（次に取り直すのは refresh_interval 後）"""
+        holidays = parse_holiday_dates(self.fetch_func())
+        self._set_holidays(holidays)
+        with self._lock:
+            self._next_refresh = time.monotonic() + self.refresh_interval
+        self._save_cache(holidays)
+        print(f"祝日一覧を更新しました（{len(holidays)}日）")
+
+    def _set_holidays(self, holidays: Set[date]):
+        """祝日一覧を差し替え、今年と来年の表を作り直す"""
+        this_year = datetime.now(JST).year
+        tables = {year: build_year_table(year, holidays) for year in (this_year, this_year + 1)}
+        with self._lock:
+            self._holidays = holidays
+            self._tables = tables
+
+    def _load_cache(self) -> Optional[float]:
+        """保存済みの祝日一覧を読み込み、取得した時刻（UNIX秒）を返す（ない・壊れている場合は None）"""
+        if not self.cache_file:
+            return None
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            holidays = {date.fromisoformat(value) for value in data['holidays']}
+            fetched_at = float(data['fetched_at'])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            print(f"保存済みの祝日一覧を読み込めませんでした: {e}")
+            return None
+        self._set_holidays(holidays)
+        return fetched_at
+
+    def _save_cache(self, holidays: Set[date]):
+        """取得した祝日一覧を保存する"""
+        if not self.cache_file:
+            return
+        data = {'fetched_at': time.time(), 'holidays': sorted(day.isoformat() for day in holidays)}
+        try:
+            atomic_write_bytes(self.cache_file, json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        except OSError as e:
+            print(f"祝日一覧を保存できませんでした: {e}")
+
+    def _table_for(self, year: int) -> bytearray:
+        """表がない年（年をまたいだ直後など）の表を、手持ちの祝日一覧から作る"""
+        with self._lock:
+            table = self._tables.get(year)
+            if table is None:
+                table = build_year_table(year, self._holidays)
+                self._tables = {**self._tables, year: table}
+            return table
+
+    def _refresh_in_background_if_due(self):
+        """取り直しの時刻を過ぎていれば、別スレッドで取得を始める（待たない）"""
+        if time.monotonic() < self._next_refresh:
+            return
+        with self._lock:
+            if self._refreshing or time.monotonic() < self._next_refresh:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._run_refresh, name='holiday-calendar-refresh', daemon=True).start()
+
+    def _run_refresh(self):
+        """取得を1回行う（成功時の次の時刻は refresh_once が決める）"""
+        try:
+            self.refresh_once()
+        except Exception as e:
+            # 取得に失敗しても手持ちの表で判定を続け、少し待ってから再試行する
+            with self._lock:
+                self._next_refresh = time.monotonic() + self.retry_interval
+            print(f"祝日一覧の取得エラー: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
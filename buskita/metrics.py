@@ -0,0 +1,471 @@
+"""
+処理時間・回数の計測と Prometheus 形式での出力
+
+上流APIの応答時間や詳細取得の所要時間などを、カウンター・ゲージ・ヒストグラムとして
+プロセス内に集計し、/metrics で Prometheus のテキスト形式（0.0.4）で返す。
+外部ライブラリは使わず、計測1回あたりはロックを取って数値を足すだけにしてある。
+
+値はプロセスごとに持つ。gunicorn の複数ワーカーで動かす場合は MultiProcessMetrics で
+各ワーカーの値を共有ディレクトリのファイル（プロセスごとに1つ）に書き出しておき、
+/metrics では全ワーカーの分を合算して返す（カウンター・ヒストグラムは合計、
+ゲージは既定では応答したワーカーの値）。
+"""
+
+import abc
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from shared_snapshot import atomic_write_bytes
+
+try:
+    import fcntl
+except ImportError:  # flock が使えない環境では、終了したプロセスのファイルをまとめない
+    fcntl = None
+
+# ヒストグラムの既定の区切り（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 終了したプロセスのカウンター・ヒストグラムをまとめておくファイルと、まとめる処理のロック
+ARCHIVE_FILE = 'archived.json'
+ARCHIVE_LOCK_FILE = '.archive.lock'
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    """ラベル値のエスケープ"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    """ラベルごとに値を持つ計測値の基底クラス"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        """
+        Args:
+            name (str): 名前（例: 'buskita_upstream_request_seconds'）
+            help_text (str): 説明
+            labels: ラベル名
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        """ラベルの値を定義順に並べる（過不足があれば ValueError）"""
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name}: ラベル {self.labels} が必要です（指定: {tuple(labels)}）")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _label_text(self, values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labels, values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def snapshot(self) -> Dict[LabelValues, Any]:
+        """ラベルの値 → 現在の値の写し（ファイルに書き出す内容）"""
+        with self._lock:
+            return {key: list(value) if isinstance(value, list) else value for key, value in self._values.items()}
+
+    def merge(self, snapshots: List[Dict[LabelValues, Any]]) -> Dict[LabelValues, Any]:
+        """全プロセスの snapshot() をまとめる（既定では値を足し合わせる）"""
+        merged: Dict[LabelValues, Any] = {}
+        for values in snapshots:
+            for key, value in values.items():
+                current = merged.get(key)
+                if current is None:
+                    merged[key] = list(value) if isinstance(value, list) else value
+                elif isinstance(current, list):
+                    if len(current) == len(value):
+                        merged[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[key] = current + value
+        return merged
+
+    @abc.abstractmethod
+    def samples(self, values: Optional[Dict[LabelValues, Any]] = None) -> List[str]:
+        """出力する行（values を渡すとこのプロセスの値の代わりにそれを出力する）"""
+
+    def render(self, values: Optional[Dict[LabelValues, Any]] = None) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"] + self.samples(values)
+
+
+class Counter(Metric):
+    """増えるだけの回数"""
+
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self, values=None):
+        items = sorted((self.snapshot() if values is None else values).items())
+        if not items and not self.labels:
+            # ラベルのないカウンターは、まだ増えていなくても 0 を出しておく
+            items = [((), 0.0)]
+        return [f"{self.name}{self._label_text(key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Metric):
+    """その時点の値（set() で入れるか、出力のたびに関数で求める）"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 func: Optional[Callable[[], Optional[float]]] = None, multiprocess_mode: str = 'local'):
+        """
+        Args:
+            func: 出力のたびに呼んで値を求める関数（ラベルなしの場合のみ。None を返したら出力しない）
+            multiprocess_mode (str): 複数プロセスの値のまとめ方
+                （'local': 応答したプロセスの値、'max': 動いているプロセスの最大値）
+        """
+        super().__init__(name, help_text, labels)
+        self.func = func
+        self.multiprocess_mode = multiprocess_mode
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def snapshot(self):
+        if self.func is not None:
+            value = self.func()
+            return {} if value is None else {(): float(value)}
+        return super().snapshot()
+
+    def merge(self, snapshots):
+        merged: Dict[LabelValues, float] = {}
+        for values in snapshots:
+            for key, value in values.items():
+                merged[key] = max(merged[key], value) if key in merged else value
+        return merged
+
+    def samples(self, values=None):
+        items = sorted((self.snapshot() if values is None else values).items())
+        return [f"{self.name}{self._label_text(key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(Metric):
+    """所要時間などの分布（区切りごとの件数と合計）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルの値 → [区切りごとの件数..., 合計, 件数]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """with ブロックの所要時間（秒）を記録する（例外で抜けた場合も記録する）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return int(entry[-1]) if entry else 0
+
+    def samples(self, values=None):
+        items = sorted((self.snapshot() if values is None else values).items())
+        lines = []
+        for key, entry in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._label_text(key, ('le', _format_value(bound)))} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_bucket{self._label_text(key, ('le', '+Inf'))} {_format_value(entry[-1])}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_format_value(entry[-2])}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {_format_value(entry[-1])}")
+        return lines
+
+
+class Registry:
+    """名前 → 計測値。同じ名前で2回登録すると最初のものを返す（モジュールの再読み込み対策）"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"{metric.name} は別の種類で登録済みです")
+                if isinstance(metric, Gauge) and metric.func is not None:
+                    existing.func = metric.func
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def metrics(self) -> List[Metric]:
+        """登録済みの計測値を名前順に返す"""
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+    def render(self, values: Optional[Dict[str, Dict[LabelValues, Any]]] = None) -> str:
+        """
+        Prometheus のテキスト形式で全体を出力する
+
+        Args:
+            values: 名前 → 出力する値（含まれない計測値はこのプロセスの値を出力する）
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.render(None if values is None else values.get(metric.name)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MultiProcessMetrics:
+    """
+    プロセスごとの値をファイルに書き出し、全プロセス分を合算して出力する
+
+    各プロセスは {directory}/{pid}_{起動時刻}.json に自分の値を一定間隔で書き出す。
+    終了したプロセスのファイルは、出力のたびにカウンターとヒストグラムを archived.json に
+    足し込んでから消す（ゲージは捨てる）。合計はワーカーが入れ替わっても減らず、
+    ファイルの数も動いているプロセスの数＋1 に保たれる。
+    """
+
+    def __init__(self, directory: str, registry: Registry = REGISTRY, interval: float = 5.0,
+                 dead_after: float = 60 * 60):
+        """
+        Args:
+            directory (str): 全プロセスで共有するディレクトリ
+            registry (Registry): 書き出す計測値
+            interval (float): 書き出す間隔（秒）
+            dead_after (float): この秒数書き出しのないプロセスは、pid が残っていても終了したとみなす
+                                （終了後に同じ pid が別のプロセスに使われた場合のため）
+        """
+        self.directory = directory
+        self.registry = registry
+        self.interval = interval
+        self.dead_after = dead_after
+        self.path = os.path.join(directory, f"{os.getpid()}_{int(time.time() * 1000)}.json")
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """一定間隔で書き出すスレッドを起動する（終了時にも書き出す）"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.write)
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                print(f"計測値の書き出しエラー: {e}")
+
+    def write(self):
+        """このプロセスの値をファイルに書き出す"""
+        data = {
+            'written_at': time.time(),
+            'metrics': {
+                metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+                for metric in self.registry.metrics()
+            }
+        }
+        atomic_write_bytes(self.path, json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def _read_file(self, name: str) -> Optional[Dict[str, Any]]:
+        """書き出したファイルを読む（書き出し途中・壊れている場合は None）"""
+        try:
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return {
+                'name': name,
+                'written_at': float(data.get('written_at', 0)),
+                'merged': list(data.get('merged', [])),
+                'metrics': {
+                    metric_name: {tuple(key): value for key, value in items}
+                    for metric_name, items in data['metrics'].items()
+                }
+            }
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            return None
+
+    def _read_processes(self) -> List[Dict[str, Any]]:
+        """全プロセスのファイルを読む"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        processes = []
+        for name in names:
+            if not name.endswith('.json') or name.startswith('.') or name == ARCHIVE_FILE:
+                continue
+            data = self._read_file(name)
+            if data is not None:
+                processes.append(data)
+        return processes
+
+    def _is_dead(self, process: Dict[str, Any]) -> bool:
+        """ファイルを書いたプロセスが終了しているか"""
+        if os.path.join(self.directory, process['name']) == self.path:
+            return False
+        if process['written_at'] < time.time() - self.dead_after:
+            return True
+        try:
+            os.kill(int(process['name'].split('_', 1)[0]), 0)
+        except ProcessLookupError:
+            return True
+        except (OSError, ValueError):
+            # 権限がない（別ユーザーのプロセス）などは動いているとみなす
+            return False
+        return False
+
+    def _archive_dead(self, processes: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        終了したプロセスのカウンター・ヒストグラムを archived.json に足し込み、そのファイルを消す
+
+        足し込んだファイル名を archived.json に残しておき、消す前に止まっても
+        次の回に二重に足さないようにする。
+
+        Returns:
+            dict: archived.json の内容（_read_file() と同じ形）
+        """
+        archive = self._read_file(ARCHIVE_FILE) or {'name': ARCHIVE_FILE, 'written_at': 0.0, 'merged': [], 'metrics': {}}
+        dead = [process for process in processes if self._is_dead(process)]
+        merged = set(archive['merged'])
+        added = [process for process in dead if process['name'] not in merged]
+        if added:
+            for metric in self.registry.metrics():
+                if isinstance(metric, Gauge):
+                    continue
+                snapshots = [archive['metrics'].get(metric.name, {})]
+                snapshots.extend(process['metrics'].get(metric.name, {}) for process in added)
+                archive['metrics'][metric.name] = metric.merge(snapshots)
+            archive['merged'] = sorted(merged | {process['name'] for process in added})
+            self._write_archive(archive)
+
+        for process in dead:
+            try:
+                os.remove(os.path.join(self.directory, process['name']))
+            except FileNotFoundError:
+                pass
+        if archive['merged']:
+            # 消し終えたファイル名はもう要らない
+            archive['merged'] = []
+            self._write_archive(archive)
+        return archive
+
+    def _write_archive(self, archive: Dict[str, Any]):
+        data = {
+            'written_at': time.time(),
+            'merged': archive['merged'],
+            'metrics': {
+                name: [[list(key), value] for key, value in values.items()]
+                for name, values in archive['metrics'].items()
+            }
+        }
+        atomic_write_bytes(os.path.join(self.directory, ARCHIVE_FILE),
+                           json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def _collect(self) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        """archived.json と、動いているプロセスのファイルを読む（終了したプロセスの分はまとめる）"""
+        if fcntl is None:
+            return self._read_file(ARCHIVE_FILE), self._read_processes()
+        with open(os.path.join(self.directory, ARCHIVE_LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                processes = self._read_processes()
+                archive = self._archive_dead(processes)
+                live = [process for process in processes
+                        if os.path.exists(os.path.join(self.directory, process['name']))]
+                return archive, live
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def render(self) -> str:
+        """全プロセスの値を合算して Prometheus のテキスト形式で出力する"""
+        self.write()
+        archive, processes = self._collect()
+        # ゲージの最大値は、最近書き出した（動いている）プロセスだけから求める
+        live_after = time.time() - self.interval * 3
+        values: Dict[str, Dict[LabelValues, Any]] = {}
+        for metric in self.registry.metrics():
+            if isinstance(metric, Gauge):
+                if metric.multiprocess_mode != 'max':
+                    continue
+                snapshots = [p['metrics'].get(metric.name, {}) for p in processes if p['written_at'] >= live_after]
+            else:
+                snapshots = [p['metrics'].get(metric.name, {}) for p in processes]
+                if archive is not None:
+                    snapshots.append(archive['metrics'].get(metric.name, {}))
+            values[metric.name] = metric.merge(snapshots)
+        return self.registry.render(values)
+
+def counter(name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+
+def gauge(name: str, help_text: str, labels: Sequence[str] = (),
+          func: Optional[Callable[[], Optional[float]]] = None, multiprocess_mode: str = 'local') -> Gauge:
+    return REGISTRY.register(Gauge(name, help_text, labels, func, multiprocess_mode))
+
+
+def histogram(name: str, help_text: str, labels: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
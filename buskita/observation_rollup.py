@@ -0,0 +1,310 @@
+"""
+観測記録（observation_store）の集計
+
+記録された観測を「路線 × 曜日（区分） × 時間帯」ごとのヒストグラムに積み上げておき、
+平均・中央値・90パーセンタイルを前もって計算した結果だけを返す。
+日付ごとのファイルは追記しかされないので、前回どこまで読んだかを覚えておき、
+更新のたびに新しく増えた行だけを読む。問い合わせの処理中に生の観測を読むことはない。
+
+ヒストグラムとどこまで読んだかは観測記録のディレクトリ（rollups/）に保存しておき、
+起動したワーカーはそこから続きを読むので、全日付の観測を読み直さずに済む。
+"""
+
+import abc
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from observation_store import MISSING_DELAY, ObservationStore
+from shared_snapshot import atomic_write_bytes
+
+# 日本時間（UTC+9）で時間帯を求めるためのずれ（秒）
+JST_OFFSET = 9 * 60 * 60
+
+
+def percentile(histogram: Counter, total: int, q: float) -> Optional[int]:
+    """ヒストグラム（値 → 件数）から q（0〜1）の位置の値を返す（最近傍順位法）"""
+    if total <= 0:
+        return None
+    rank = max(1, math.ceil(q * total))
+    seen = 0
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if seen >= rank:
+            return value
+    return None
+
+
+def summarize(histogram: Counter) -> Dict[str, Any]:
+    """ヒストグラムから件数・平均・中央値・90パーセンタイルを計算する"""
+    total = sum(histogram.values())
+    mean = sum(value * count for value, count in histogram.items()) / total if total else None
+    return {
+        'count': total,
+        'mean': round(mean, 2) if mean is not None else None,
+        'p50': percentile(histogram, total, 0.5),
+        'p90': percentile(histogram, total, 0.9)
+    }
+
+
+class ObservationRollup(abc.ABC):
+    """観測記録を差分で読み込み、キーごとのヒストグラムを保つ集計の基底クラス"""
+
+    # 集計に使う列（サブクラスで指定する）
+    columns: Tuple[str, ...] = ('ts', 'route')
+
+    def __init__(self,
+                 store: ObservationStore,
+                 day_type_func: Callable[[date], str],
+                 refresh_interval: float = 60.0,
+                 state_file: Optional[str] = None):
+        """
+        Args:
+            store (ObservationStore): 観測記録
+            day_type_func: 日付から曜日区分を返す関数（HolidayCalendar.day_type など）
+            refresh_interval (float): 新しい観測を読み込む間隔（秒）
+            state_file (str): 集計の途中経過の保存先（省略時は {store.base_dir}/rollups/{クラス名}.json）
+        """
+        self.store = store
+        self.day_type_func = day_type_func
+        self.refresh_interval = refresh_interval
+        self.state_file = state_file or os.path.join(store.base_dir, 'rollups', f"{type(self).__name__}.json")
+        self._state_loaded = False
+        self._histograms: Dict[Hashable, Counter] = defaultdict(Counter)
+        self._rows_done: Dict[str, int] = {}
+        self._day_types: Dict[str, str] = {}
+        self._summary: Dict[Hashable, Dict[str, Any]] = {}
+        self._updated_at = 0.0
+        self._next_refresh = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def refresh_once(self) -> int:
+        """
+        前回の続きから新しい観測を読み込み、変わったキーだけ集計し直す
+
+        Returns:
+            int: 読み込んだ行数
+        """
+        if not self._state_loaded:
+            # 初回は保存済みの途中経過から始め、それ以降に増えた行だけを読む
+            self._load_state()
+            self._state_loaded = True
+
+        # 祝日一覧が後から届くなどして日付の曜日区分が変わった場合は、最初から数え直す
+        if any(self.day_type_func(date.fromisoformat(p)) != day_type for p, day_type in self._day_types.items()):
+            self._histograms = defaultdict(Counter)
+            self._rows_done = {}
+            self._day_types = {}
+            self._summary = {}
+            self.materialize({})
+
+        added = 0
+        dirty = set()
+        for partition in self.store.partitions():
+            start_row = self._rows_done.get(partition, 0)
+            data = self.store.read(partition, list(self.columns), start_row=start_row)
+            rows = len(data['ts'])
+            if not rows:
+                continue
+            day_type = self._day_types.setdefault(partition, self.day_type_func(date.fromisoformat(partition)))
+            dirty.update(self.add_rows(data, day_type, date.fromisoformat(partition)))
+            self._rows_done[partition] = start_row + rows
+            added += rows
+
+        if dirty:
+            summary = dict(self._summary)
+            for key in dirty:
+                summary[key] = summarize(self._histograms[key])
+            self.materialize(summary)
+            # 問い合わせ側は差し替え後の辞書を読むだけなので、ロックなしで読める
+            self._summary = summary
+        if added:
+            self._save_state()
+        self._updated_at = time.time()
+        return added
+
+    @abc.abstractmethod
+    def add_rows(self, data: Dict[str, Any], day_type: str, day: date) -> set:
+        """1日分の新しい行をヒストグラムに加え、変わったキーを返す"""
+
+    def _load_state(self):
+        """保存済みの途中経過を読み込む（ない・壊れている・列が違う場合は最初から数える）"""
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('columns') != list(self.columns):
+                return
+            histograms: Dict[Hashable, Counter] = defaultdict(Counter)
+            for key, items in state['histograms']:
+                histograms[tuple(key)] = Counter({value: count for value, count in items})
+            rows_done = {str(p): int(rows) for p, rows in state['rows_done'].items()}
+            day_types = {str(p): str(day_type) for p, day_type in state['day_types'].items()}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            print(f"保存済みの集計を読み込めないため、最初から集計します: {e}")
+            return
+
+        summary = {key: summarize(histogram) for key, histogram in histograms.items()}
+        self._histograms = histograms
+        self._rows_done = rows_done
+        self._day_types = day_types
+        self.materialize(summary)
+        self._summary = summary
+
+    def _save_state(self):
+        """
+        途中経過を保存する
+
+        複数のワーカーが同じファイルに書いても、どれも「ある行数まで読んだ結果」として
+        食い違いのない内容なので、最後に書いたものが残ればよい。
+        """
+        state = {
+            'columns': list(self.columns),
+            'rows_done': self._rows_done,
+            'day_types': self._day_types,
+            'histograms': [[list(key), sorted(histogram.items())] for key, histogram in self._histograms.items()],
+        }
+        try:
+            atomic_write_bytes(self.state_file, json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        except OSError as e:
+            print(f"集計の途中経過を保存できませんでした: {e}")
+
+    def materialize(self, summary: Dict[Hashable, Dict[str, Any]]):
+        """集計結果が変わったときに、問い合わせ用の表を作り直す（必要なサブクラスで実装する）"""
+
+    def summary(self) -> Dict[Hashable, Dict[str, Any]]:
+        """キー → 集計結果を返す（必要なら裏で新しい観測の読み込みを始める）"""
+        self._refresh_in_background_if_due()
+        return self._summary
+
+    @property
+    def updated_at(self) -> float:
+        """最後に集計を更新した時刻（UNIX秒）"""
+        return self._updated_at
+
+    def _refresh_in_background_if_due(self):
+        """更新の時刻を過ぎていれば、別スレッドで読み込みを始める（待たない）"""
+        if time.monotonic() < self._next_refresh:
+            return
+        with self._lock:
+            if self._refreshing or time.monotonic() < self._next_refresh:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._run_refresh, name=f"{type(self).__name__}-refresh", daemon=True).start()
+
+    def _run_refresh(self):
+        """読み込みを1回行い、次に更新する時刻を決める"""
+        try:
+            self.refresh_once()
+        except Exception as e:
+            # 読み込みに失敗しても直前の集計を返し続ける
+            print(f"観測データの集計エラー: {e}")
+        finally:
+            with self._lock:
+                self._next_refresh = time.monotonic() + self.refresh_interval
+                self._refreshing = False
+
+
+class DelayRollup(ObservationRollup):
+    """遅延（delayMinutes）を 路線 × 曜日区分 × 時（0〜23）ごとに集計する"""
+
+    columns = ('ts', 'route', 'delay')
+
+    def add_rows(self, data, day_type, day):
+        routes = data['routes']
+        histograms = self._histograms
+        dirty = set()
+        for ts, route_id, delay in zip(data['ts'], data['route'], data['delay']):
+            if delay == MISSING_DELAY:
+                continue
+            route = routes[route_id] if route_id < len(routes) else ''
+            key = (route, day_type, (ts + JST_OFFSET) % 86400 // 3600)
+            histograms[key][delay] += 1
+            dirty.add(key)
+        return dirty
+
+    def query(self, route: Optional[str] = None, day_type: Optional[str] = None,
+              hour: Optional[int] = None) -> List[Dict[str, Any]]:
+        """条件に合う集計結果を 路線・曜日区分・時 の順に並べて返す"""
+        results = []
+        for (key_route, key_day_type, key_hour), stats in self.summary().items():
+            if route is not None and key_route != route:
+                continue
+            if day_type is not None and key_day_type != day_type:
+                continue
+            if hour is not None and key_hour != hour:
+                continue
+            results.append(dict(stats, route=key_route, day_type=key_day_type, hour=key_hour))
+        results.sort(key=lambda item: (item['route'], item['day_type'], item['hour']))
+        return results
+
+
+class OccupancyRollup(ObservationRollup):
+    """
+    乗車率（乗客数 / 定員、5%刻み）を 路線 × 曜日 × 15分枠 ごとに集計する
+
+    曜日は月曜=0〜日曜=6。祝日は日曜と同じダイヤなので 6 として数える。
+    """
+
+    columns = ('ts', 'route', 'passenger', 'capacity')
+
+    # 1枠の長さ（秒）と、乗車率を丸める刻み（%）
+    SLOT_SECONDS = 15 * 60
+    STEP_PERCENT = 5
+    # 混雑度の判定に使う中央値のしきい値（%）と、判定に必要な最低件数
+    LEVELS = ((80, 'crowded'), (50, 'busy'), (0, 'normal'))
+    MIN_COUNT = 20
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (曜日, 枠) → [路線ごとの集計結果]
+        self._by_slot: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+
+    @staticmethod
+    def weekday_for(day: date, day_type: str) -> int:
+        """集計に使う曜日（祝日は日曜扱い）"""
+        return 6 if day_type == 'holidays' else day.weekday()
+
+    def add_rows(self, data, day_type, day):
+        routes = data['routes']
+        histograms = self._histograms
+        weekday = self.weekday_for(day, day_type)
+        step = self.STEP_PERCENT
+        dirty = set()
+        for ts, route_id, passenger, capacity in zip(data['ts'], data['route'], data['passenger'], data['capacity']):
+            if passenger < 0 or capacity <= 0:
+                continue
+            route = routes[route_id] if route_id < len(routes) else ''
+            key = (route, weekday, (ts + JST_OFFSET) % 86400 // self.SLOT_SECONDS)
+            histograms[key][passenger * 100 // capacity // step * step] += 1
+            dirty.add(key)
+        return dirty
+
+    def level_for(self, stats: Dict[str, Any]) -> Optional[str]:
+        """中央値の乗車率から混雑度を決める（件数が少なすぎる場合は None）"""
+        if stats['count'] < self.MIN_COUNT or stats['p50'] is None:
+            return None
+        for threshold, level in self.LEVELS:
+            if stats['p50'] >= threshold:
+                return level
+        return None
+
+    def materialize(self, summary):
+        by_slot: Dict[Tuple[int, int], List[Dict[str, Any]]] = defaultdict(list)
+        for (route, weekday, slot), stats in summary.items():
+            by_slot[(weekday, slot)].append(dict(stats, route=route, level=self.level_for(stats)))
+        for entries in by_slot.values():
+            entries.sort(key=lambda item: item['route'])
+        self._by_slot = dict(by_slot)
+
+    def forecast(self, weekday: int, slot: int) -> List[Dict[str, Any]]:
+        """指定した曜日・枠の路線ごとの集計結果（乗車率 %）と混雑度を返す"""
+        self._refresh_in_background_if_due()
+        return self._by_slot.get((weekday, slot), [])
@@ -0,0 +1,270 @@
+"""
+乗客数・遅延の観測記録（混雑分析フェーズ1）
+
+バス位置の定期取得のたびに、各バスの乗客数・定員・混雑度・遅延を
+1行の観測として記録する。記録は日付（日本時間）ごとのディレクトリに
+列ごとのバイナリファイル（array のバイト列）として追記するだけなので、
+3秒周期で全車両を数週間分ためても書き込みは軽く、後から1列だけを
+まとめて読み出せる。
+
+    {base_dir}/2025-07-01/ts.bin          取得時刻（UNIX秒）
+                          work_no.bin     バスID（workNo）
+                          route.bin       路線番号（routes.txt の行番号）
+                          passenger.bin   乗客数
+                          capacity.bin    定員
+                          occupancy.bin   混雑度（occupancyStatus）
+                          delay.bin       遅延（分）
+                          routes.txt      路線名（行き先）の一覧
+
+値がない項目は -1（遅延は負の値もとるので -32768）を記録する。
+"""
+
+import os
+import threading
+import time
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from departure_index import JST
+
+# 列名と array の型コード（ファイルの中身は書き込んだマシンのバイト順のまま）
+COLUMNS: Tuple[Tuple[str, str], ...] = (
+    ('ts', 'q'),
+    ('work_no', 'q'),
+    ('route', 'i'),
+    ('passenger', 'h'),
+    ('capacity', 'h'),
+    ('occupancy', 'b'),
+    ('delay', 'h'),
+)
+MISSING = -1
+MISSING_DELAY = -2 ** 15
+ROUTES_FILE = 'routes.txt'
+
+
+def partition_name(ts: float) -> str:
+    """取得時刻が属する日付（日本時間）のディレクトリ名"""
+    return datetime.fromtimestamp(ts, JST).strftime('%Y-%m-%d')
+
+
+def _int_or_missing(value, low: int, high: int, missing: int = MISSING) -> int:
+    """整数に変換し、変換できない・型に収まらない値は missing にする"""
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return missing
+    return number if low <= number <= high else missing
+
+
+class ObservationStore:
+    """日付ごとに列を分けて観測を追記・読み出しする"""
+
+    def __init__(self, base_dir: str):
+        """
+        Args:
+            base_dir (str): 日付ごとのディレクトリを置く場所
+        """
+        self.base_dir = base_dir
+        # 日付 → {路線名: 番号}（書き込み用に開いた日付だけ持つ）
+        self._route_ids: Dict[str, Dict[str, int]] = {}
+        # このプロセスで列の長さをそろえ終えた日付
+        self._aligned: Set[str] = set()
+
+    def partitions(self) -> List[str]:
+        """記録のある日付を古い順に返す"""
+        if not os.path.isdir(self.base_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(self.base_dir)
+            if os.path.isfile(os.path.join(self.base_dir, name, 'ts.bin'))
+        )
+
+    def append(self, partition: str, columns: Dict[str, array], route_names: List[str]):
+        """
+        1日分のディレクトリに観測をまとめて追記する
+
+        Args:
+            partition (str): 日付（'YYYY-MM-DD'）
+            columns (dict): 列名 → 同じ長さの array
+            route_names (list): columns['route'] の番号を振るときに使った路線名（番号順）
+        """
+        directory = os.path.join(self.base_dir, partition)
+        os.makedirs(directory, exist_ok=True)
+
+        # 番号が指す路線名を先に書いておき、列だけ書かれて名前がない状態を作らない
+        known = self._load_route_ids(partition)
+        new_names = route_names[len(known):]
+        if new_names:
+            with open(os.path.join(directory, ROUTES_FILE), 'a', encoding='utf-8') as f:
+                f.write(''.join(f"{name}\n" for name in new_names))
+            for name in new_names:
+                known[name] = len(known)
+
+        if partition not in self._aligned:
+            self._align_columns(directory)
+            self._aligned.add(partition)
+        try:
+            for name, _ in COLUMNS:
+                with open(os.path.join(directory, f"{name}.bin"), 'ab') as f:
+                    columns[name].tofile(f)
+        except BaseException:
+            # 一部の列だけ書けた可能性があるので、次の追記の前にそろえ直す
+            self._aligned.discard(partition)
+            raise
+
+    @staticmethod
+    def _align_columns(directory: str):
+        """
+        すべての列ファイルを最も短い列の行数に切り詰める
+
+        前回の追記が途中で止まって列の長さがずれたまま追記すると、以降の行で
+        別々の観測の値が組み合わさってしまうので、追記を始める前にそろえておく。
+        """
+        sizes = {}
+        for name, code in COLUMNS:
+            path = os.path.join(directory, f"{name}.bin")
+            itemsize = array(code).itemsize
+            sizes[name] = (path, itemsize, os.path.getsize(path) if os.path.exists(path) else 0)
+        rows = min(size // itemsize for _, itemsize, size in sizes.values())
+        for name, (path, itemsize, size) in sizes.items():
+            if size != rows * itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(rows * itemsize)
+                print(f"観測データの列の長さをそろえました: {name}（{size // itemsize} → {rows}行）")
+
+    def route_ids(self, partition: str) -> Dict[str, int]:
+        """書き込み用に、その日の {路線名: 番号} を返す（新しい路線は呼び出し側で末尾に足す）"""
+        return dict(self._load_route_ids(partition))
+
+    def read(self, partition: str, names: Optional[List[str]] = None, start_row: int = 0) -> Dict[str, Any]:
+        """
+        1日分の列を読み出す
+
+        Args:
+            partition (str): 日付（'YYYY-MM-DD'）
+            names (list): 読む列名（省略時はすべて）
+            start_row (int): この行から後だけを読む（前回読んだ続きから読むときに使う）
+
+        Returns:
+            dict: 列名 → array と 'routes'（路線名のリスト）。書き込み途中で止まった
+                  場合に備え、すべての列を最も短い列の長さにそろえる
+        """
+        directory = os.path.join(self.base_dir, partition)
+        wanted = [(name, code) for name, code in COLUMNS if names is None or name in names]
+        rows = min(
+            os.path.getsize(os.path.join(directory, f"{name}.bin")) // array(code).itemsize
+            if os.path.exists(os.path.join(directory, f"{name}.bin")) else 0
+            for name, code in COLUMNS
+        )
+
+        result: Dict[str, Any] = {}
+        for name, code in wanted:
+            values = array(code)
+            if rows > start_row:
+                with open(os.path.join(directory, f"{name}.bin"), 'rb') as f:
+                    f.seek(start_row * values.itemsize)
+                    values.fromfile(f, rows - start_row)
+            result[name] = values
+        result['routes'] = self._read_route_names(directory)
+        return result
+
+    def scan(self, start: Optional[str] = None, end: Optional[str] = None,
+             names: Optional[List[str]] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """start〜end（両端を含む、'YYYY-MM-DD'）の日付ごとに read() の結果を返す"""
+        for partition in self.partitions():
+            if (start and partition < start) or (end and partition > end):
+                continue
+            yield partition, self.read(partition, names)
+
+    def _load_route_ids(self, partition: str) -> Dict[str, int]:
+        """その日の路線名の番号を（初回だけファイルから）読み込む"""
+        ids = self._route_ids.get(partition)
+        if ids is None:
+            names = self._read_route_names(os.path.join(self.base_dir, partition))
+            ids = {name: i for i, name in enumerate(names)}
+            # 書き込み中の日付だけ覚えておけばよいので、古い日付は捨てる
+            self._route_ids = {partition: ids}
+        return ids
+
+    @staticmethod
+    def _read_route_names(directory: str) -> List[str]:
+        """routes.txt を読み、番号順の路線名リストを返す"""
+        path = os.path.join(directory, ROUTES_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().splitlines()
+
+
+class ObservationRecorder:
+    """取得したバス情報をためておき、件数か時間のしきい値でまとめて書き込む"""
+
+    def __init__(self, store: ObservationStore, max_rows: int = 2000, max_interval: float = 60.0):
+        """
+        Args:
+            store (ObservationStore): 書き込み先
+            max_rows (int): この件数たまったら書き込む
+            max_interval (float): 最後の書き込みからこの秒数が過ぎたら書き込む
+        """
+        self.store = store
+        self.max_rows = max_rows
+        self.max_interval = max_interval
+        self._partition: Optional[str] = None
+        self._columns = {name: array(code) for name, code in COLUMNS}
+        self._route_ids: Dict[str, int] = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, buses: List[Dict[str, Any]], fetched_at: float):
+        """
+        1回の取得分（get-buses の生データ）を観測として加える
+
+        Args:
+            buses (list): 生のバス情報のリスト
+            fetched_at (float): 取得時刻（UNIX秒）
+        """
+        partition = partition_name(fetched_at)
+        with self._lock:
+            if partition != self._partition:
+                # 日付が変わったら前日分を書き切ってから新しい日付に切り替える
+                self._flush_locked()
+                self._partition = partition
+                self._route_ids = self.store.route_ids(partition)
+
+            columns = self._columns
+            ts = int(fetched_at)
+            for bus in buses:
+                if not bus:
+                    continue
+                route_name = ((bus.get('routeNames') or {}).get('1') or '').replace('\n', ' ')
+                route_id = self._route_ids.setdefault(route_name, len(self._route_ids))
+                columns['ts'].append(ts)
+                columns['work_no'].append(_int_or_missing(bus.get('workNo'), 0, 2 ** 63 - 1))
+                columns['route'].append(route_id)
+                columns['passenger'].append(_int_or_missing(bus.get('passenger'), 0, 2 ** 15 - 1))
+                columns['capacity'].append(_int_or_missing(bus.get('capacity'), 0, 2 ** 15 - 1))
+                columns['occupancy'].append(_int_or_missing(bus.get('occupancyStatus'), 0, 127))
+                columns['delay'].append(_int_or_missing(bus.get('delayMinutes'), -2 ** 15 + 1, 2 ** 15 - 1, MISSING_DELAY))
+
+            if len(columns['ts']) >= self.max_rows or time.monotonic() - self._last_flush >= self.max_interval:
+                self._flush_locked()
+
+    def flush(self):
+        """ためている観測をすべて書き込む"""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        """ロックを持った状態で書き込み、バッファを空にする"""
+        self._last_flush = time.monotonic()
+        columns = self._columns
+        self._columns = {name: array(code) for name, code in COLUMNS}
+        if self._partition is None or not columns['ts']:
+            return
+        route_names = sorted(self._route_ids, key=self._route_ids.get)
+        try:
+            self.store.append(self._partition, columns, route_names)
+        except OSError as e:
+            # 記録に失敗してもバス位置の配信は止めない（この回の観測は捨てる）
+            print(f"観測データの書き込みエラー: {e}")
@@ -0,0 +1,235 @@
+"""
+記録した応答を再生する buskita API の代役
+
+snapshot_archive に記録した get-buses の応答（bus_monitor の記録など）を、
+記録したときの間隔のまま、または speed 倍の速さで再生する。web_map_app の
+BUSKITA_API_BASE_URL をこのサーバーに向ければ、api.buskita.com に接続せずに
+地図アプリを動かし、同じ入力で何度でも負荷をかけられる。
+
+    get-buses                 再生位置の時点の一覧（サイトごと）
+    get-bus                   再生位置の一覧にある該当バス
+    get-holidays              空の祝日一覧
+    辞書・辞書バージョン       DictionaryCache が保存したファイル（なければ空の辞書）
+
+記録がない場合はバックアップファイル（BACKUP_FILE、既定ではリポジトリ直下の
+archive/last_known_buses.json）を1コマだけの記録として使う。
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import Flask, jsonify, request
+
+from departure_index import JST
+from dictionary_cache import DEFAULT_CACHE_DIR, DICTIONARIES, VERSION_ENDPOINTS
+from snapshot_archive import SnapshotArchive
+
+# web_map_app と同じ BACKUP_FILE を使い、指定がなければリポジトリ直下の archive/ にあるものを使う
+DEFAULT_BACKUP_FILE = os.environ.get(
+    'BACKUP_FILE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'archive', 'last_known_buses.json')
+)
+
+
+class ReplaySource:
+    """サイトごとの (取得時刻, バス一覧) の列（サイトを問わない記録は None に入れる）"""
+
+    def __init__(self, frames: Dict[Optional[int], List[Tuple[float, List[Dict[str, Any]]]]]):
+        self.frames = {site: sorted(items, key=lambda item: item[0]) for site, items in frames.items() if items}
+        self._times = {site: [ts for ts, _ in items] for site, items in self.frames.items()}
+        all_times = [ts for times in self._times.values() for ts in times]
+        self.first_ts = min(all_times) if all_times else 0.0
+        self.last_ts = max(all_times) if all_times else 0.0
+        # コマの平均の間隔（ループ再生で最後のコマを見せておく長さ）
+        longest = max((len(times) for times in self._times.values()), default=1)
+        self.step = (self.last_ts - self.first_ts) / max(longest - 1, 1)
+
+    @classmethod
+    def from_archive(cls, archive: SnapshotArchive, start: Optional[float] = None,
+                     end: Optional[float] = None) -> 'ReplaySource':
+        """アーカイブの get-buses の記録から作る（'site' のない記録はどのサイトにも返す）"""
+        frames: Dict[Optional[int], List[Tuple[float, List[Dict[str, Any]]]]] = {}
+        for record in archive.read(start, end):
+            data = record.get('data')
+            if not isinstance(data, dict) or not isinstance(data.get('buses'), list):
+                continue
+            frames.setdefault(record.get('site'), []).append((record['ts'], data['buses']))
+        return cls(frames)
+
+    @classmethod
+    def from_buses(cls, buses: List[Dict[str, Any]], ts: Optional[float] = None) -> 'ReplaySource':
+        """1コマだけの記録（バックアップファイルや合成したバス一覧）から作る"""
+        return cls({None: [(time.time() if ts is None else ts, buses)]})
+
+    @property
+    def sites(self) -> List[Optional[int]]:
+        return list(self.frames)
+
+    def frame_at(self, site: Optional[int], ts: float) -> List[Dict[str, Any]]:
+        """ts 時点で最新だったバス一覧（記録がなければ空）"""
+        key = site if site in self.frames else None
+        times = self._times.get(key)
+        if not times:
+            return []
+        index = bisect.bisect_right(times, ts) - 1
+        return self.frames[key][max(index, 0)][1]
+
+
+class ReplayServer:
+    """ReplaySource を再生し、buskita API と同じ形で応答する Flask アプリ"""
+
+    def __init__(self,
+                 source: ReplaySource,
+                 speed: float = 1.0,
+                 loop: bool = True,
+                 latency: float = 0.0,
+                 dictionary_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                 language: int = 1):
+        """
+        Args:
+            source (ReplaySource): 再生する記録
+            speed (float): 再生の速さ（2.0 なら記録の2倍速）
+            loop (bool): 最後まで再生したら最初に戻る
+            latency (float): 応答を返す前に待つ時間（秒）。上流の遅さを再現するのに使う
+            dictionary_dir (str): DictionaryCache の保存先（辞書の応答に使う）
+            language (int): 辞書ファイルを探すときの言語設定
+        """
+        self.source = source
+        self.speed = speed
+        self.loop = loop
+        self.latency = latency
+        self.dictionary_dir = dictionary_dir
+        self.language = language
+        # エンドポイント → 呼ばれた回数（ベンチマークで上流への呼び出し数を数えるのに使う）
+        self.calls: Counter = Counter()
+        self._calls_lock = threading.Lock()
+        self._started = time.monotonic()
+        self.app = self._create_app()
+
+    def restart(self):
+        """再生位置を最初に戻し、呼び出し回数を数え直す"""
+        self._started = time.monotonic()
+        self.reset_calls()
+
+    def reset_calls(self) -> Dict[str, int]:
+        """呼び出し回数を 0 に戻し、それまでの回数を返す"""
+        with self._calls_lock:
+            calls, self.calls = dict(self.calls), Counter()
+        return calls
+
+    def position(self) -> float:
+        """現在の再生位置（記録上の時刻、UNIX秒）"""
+        source = self.source
+        span = source.last_ts - source.first_ts
+        elapsed = (time.monotonic() - self._started) * self.speed
+        if span <= 0:
+            return source.first_ts
+        if self.loop:
+            # 最後のコマも1コマ分の長さだけ見せてから最初に戻る
+            return source.first_ts + elapsed % (span + source.step)
+        return source.first_ts + min(elapsed, span)
+
+    def _count(self, endpoint: str):
+        with self._calls_lock:
+            self.calls[endpoint] += 1
+
+    def _dictionary(self, name: str, site_id: Any) -> Dict[str, Any]:
+        """保存済みの辞書ファイル（DictionaryCache の形式）を読む"""
+        if self.dictionary_dir:
+            path = os.path.join(self.dictionary_dir, f"site{site_id}_lang{self.language}_{name}.json")
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {'version': 0, 'response': {}}
+
+    def _create_app(self) -> Flask:
+        app = Flask(__name__)
+        dictionary_endpoints = {endpoint: name for name, (endpoint, _, _) in DICTIONARIES.items()}
+        version_endpoints = {endpoint: (kind, key) for kind, (endpoint, key) in VERSION_ENDPOINTS.items()}
+
+        @app.route('/<endpoint>', methods=['POST'])
+        def api(endpoint):
+            self._count(endpoint)
+            if self.latency > 0:
+                time.sleep(self.latency)
+            payload = request.get_json(silent=True) or {}
+            site_id = payload.get('siteId')
+
+            if endpoint == 'get-buses':
+                return jsonify({'buses': self.source.frame_at(site_id, self.position())})
+            if endpoint == 'get-bus':
+                work_no = str(payload.get('workNo'))
+                buses = self.source.frame_at(site_id, self.position())
+                return jsonify({'bus': [bus for bus in buses if str(bus.get('workNo')) == work_no][:1]})
+            if endpoint == 'get-holidays':
+                return jsonify({'holidays': {}})
+            if endpoint in dictionary_endpoints:
+                return jsonify(self._dictionary(dictionary_endpoints[endpoint], site_id if site_id is not None else 9)['response'])
+            if endpoint in version_endpoints:
+                kind, key = version_endpoints[endpoint]
+                versions = [
+                    self._dictionary(name, site_id if site_id is not None else 9).get('version')
+                    for name, (_, _, name_kind) in DICTIONARIES.items() if name_kind == kind
+                ]
+                return jsonify({key: next((v for v in versions if v), 0)})
+            return jsonify({'error': f'unknown endpoint: {endpoint}'}), 404
+
+        @app.route('/_replay/stats')
+        def stats():
+            """再生位置と呼び出し回数（?reset=1 で数え直す）"""
+            calls = self.reset_calls() if request.args.get('reset') else dict(self.calls)
+            return jsonify({
+                'position': datetime.fromtimestamp(self.position(), JST).isoformat(),
+                'speed': self.speed,
+                'sites': [site for site in self.source.sites if site is not None],
+                'calls': calls
+            })
+
+        return app
+
+
+def load_source(stream: str = 'bus_monitor', start: Optional[float] = None, end: Optional[float] = None,
+                backup_file: str = DEFAULT_BACKUP_FILE) -> ReplaySource:
+    """アーカイブの記録を読み、なければバックアップファイルの1コマを使う"""
+    source = ReplaySource.from_archive(SnapshotArchive(stream), start, end)
+    if source.frames:
+        return source
+    with open(backup_file, 'r', encoding='utf-8') as f:
+        return ReplaySource.from_buses(json.load(f))
+
+
+def _parse_time(value: Optional[str]) -> Optional[float]:
+    """'2025-07-01T08:00' の形（日本時間）を UNIX秒にする"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=JST)
+    return parsed.timestamp()
+
+
+if __name__ == '__main__':
+    source = load_source(
+        os.environ.get('REPLAY_STREAM', 'bus_monitor'),
+        _parse_time(os.environ.get('REPLAY_START')),
+        _parse_time(os.environ.get('REPLAY_END'))
+    )
+    server = ReplayServer(
+        source,
+        speed=float(os.environ.get('REPLAY_SPEED', '1')),
+        loop=os.environ.get('REPLAY_LOOP', '1') != '0',
+        latency=float(os.environ.get('REPLAY_LATENCY', '0'))
+    )
+    frame_count = sum(len(items) for items in source.frames.values())
+    print(f"{frame_count}コマを {server.speed:g} 倍速で再生します"
+          f"（{datetime.fromtimestamp(source.first_ts, JST):%Y-%m-%d %H:%M:%S} 〜 "
+          f"{datetime.fromtimestamp(source.last_ts, JST):%Y-%m-%d %H:%M:%S}）")
+    server.app.run(host='0.0.0.0', port=int(os.environ.get('REPLAY_PORT', '5050')), threaded=True)
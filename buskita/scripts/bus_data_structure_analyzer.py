@@ -1,26 +1,30 @@
-import requests
+import os
+import sys
 import json
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 import pandas as pd
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buskita_client import API_BASE_URL, BuskitaClient
+
 class BusDataStructureAnalyzer:
     """バスデータ構造の詳細分析クラス"""
     
     def __init__(self):
-        self.base_url = "https://api.buskita.com"
+        self.base_url = API_BASE_URL
         self.headers = {
             'Accept': 'application/json, text/plain, */*',
             'Accept-Language': 'ja',
             'Content-Type': 'application/json',
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
         }
+        self.client = BuskitaClient(base_url=self.base_url, headers=self.headers)
         
     def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """APIリクエストを実行"""
         try:
-            url = f"{self.base_url}/{endpoint}"
-            response = requests.post(url, headers=self.headers, json=data)
+            response = self.client.post(endpoint, data)
             
             if response.status_code == 200:
                 return response.json()
@@ -1,26 +1,41 @@
-import requests
+import os
+import sys
 import json
 import time
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buskita_client import API_BASE_URL, BuskitaClient
+from dictionary_cache import DictionaryCache
+
 class BusIDExplorer:
     """バスID情報を探索するクラス"""
     
     def __init__(self):
-        self.base_url = "https://api.buskita.com"
+        self.base_url = API_BASE_URL
         self.headers = {
             'Accept': 'application/json, text/plain, */*',
             'Accept-Language': 'ja',
             'Content-Type': 'application/json',
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
         }
+        self.client = BuskitaClient(base_url=self.base_url, headers=self.headers)
+        # 静的な辞書はバージョンが変わったときだけ取得する
+        self.dictionaries = DictionaryCache(self.client, site_id=9)
+        
+    def _get_dictionary(self, name: str) -> Optional[Dict[str, Any]]:
+        """辞書をローカルキャッシュ経由で取得"""
+        try:
+            return self.dictionaries.get(name)
+        except Exception as e:
+            print(f"リクエストエラー: {str(e)}")
+            return None
         
     def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """APIリクエストを実行"""
         try:
-            url = f"{self.base_url}/{endpoint}"
-            response = requests.post(url, headers=self.headers, json=data)
+            response = self.client.post(endpoint, data)
             
             if response.status_code == 200:
                 return response.json()
@@ -146,7 +161,7 @@ class BusIDExplorer:
         print("=" * 60)
         
         # バス停グルーピング情報からバス停番号を取得
-        grouping_result = self._make_request('get-busstops-grouping', {'language': 1, 'siteId': 9})
+        grouping_result = self._get_dictionary('busstops_grouping')
         if grouping_result and 'groupings' in grouping_result:
             print(f"\n🚏 バス停グルーピング情報: {len(grouping_result['groupings'])}件")
             
@@ -181,7 +196,7 @@ class BusIDExplorer:
         print("=" * 60)
         
         # バス会社情報を取得
-        companies_result = self._make_request('get-companies-dictionary', {'language': 1})
+        companies_result = self._get_dictionary('companies')
         if not companies_result or 'companiesDictionary' not in companies_result:
             print("バス会社情報の取得に失敗")
             return
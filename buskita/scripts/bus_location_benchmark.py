@@ -0,0 +1,251 @@
+"""
+バス位置配信の負荷計測
+
+再生サーバー（replay_server）に台数を変えた合成の記録を載せて上流APIの代わりにし、
+web_map_app を同じプロセスに読み込んで次の3つを計測する。
+
+    get_live_bus_data()         上流からの取得（get-buses + get-bus）。初回（詳細キャッシュなし）と2回目以降
+    filter_and_format_buses()   生のバス一覧の整形
+    /api/bus_locations          閲覧者数（同時リクエスト数）を変えたときの応答時間と処理数
+
+/api/bus_locations は Flask のテストクライアントで呼ぶので、ソケットやWSGIサーバーの
+時間は含まない（アプリ内の処理だけを比べるための数字）。条件は環境変数で変える。
+
+    BENCH_FLEET_SIZES    台数（既定値 10,100,500,1000）
+    BENCH_CONCURRENCY    同時リクエスト数（既定値 1,8,32）
+    BENCH_LATENCIES      上流の応答の遅さ（秒、既定値 0,0.05）
+    BENCH_REQUESTS       1条件あたりのリクエスト数（既定値 500）
+    BENCH_QUERY          /api/bus_locations に付けるクエリ（例: bbox=135.90,34.93,135.95,34.96）
+    BENCH_OUTPUT         結果をJSONで書き出すファイル
+"""
+
+import json
+import logging
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BUSKITA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BUSKITA_DIR)
+
+
+def free_port():
+    """空いているポート番号"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# buskita_client と web_map_app は読み込み時に設定を読むので、読み込む前に
+# 接続先を再生サーバーに、書き込み先を一時ディレクトリに差し替える
+REPLAY_PORT = free_port()
+WORK_DIR = tempfile.mkdtemp(prefix='buskita_bench_')
+os.environ.update({
+    'BUSKITA_API_BASE_URL': f"http://127.0.0.1:{REPLAY_PORT}",
+    'BUS_SNAPSHOT_DIR': WORK_DIR,
+    'BACKUP_FILE': os.path.join(WORK_DIR, 'last_known_buses.json'),
+    'BUSKITA_DICTIONARY_CACHE_DIR': os.path.join(WORK_DIR, 'dictionaries'),
+    'OBSERVATION_DIR': '',
+})
+
+from werkzeug.serving import make_server
+
+from replay_server import ReplayServer, ReplaySource
+
+FLEET_SIZES = [int(v) for v in os.environ.get('BENCH_FLEET_SIZES', '10,100,500,1000').split(',')]
+CONCURRENCY = [int(v) for v in os.environ.get('BENCH_CONCURRENCY', '1,8,32').split(',')]
+LATENCIES = [float(v) for v in os.environ.get('BENCH_LATENCIES', '0,0.05').split(',')]
+REQUESTS = int(os.environ.get('BENCH_REQUESTS', '500'))
+QUERY = os.environ.get('BENCH_QUERY', '')
+OUTPUT = os.path.abspath(os.environ['BENCH_OUTPUT']) if os.environ.get('BENCH_OUTPUT') else None
+
+# 合成するバスの行き先と、位置をばらまく範囲（瀬田キャンパス周辺）
+DESTINATIONS = ['龍谷大学行き', '瀬田駅行き', '南草津駅行き', '大江団地行き', '石山駅行き']
+CENTER = (34.9445, 135.9134)
+SPREAD_DEG = 0.05
+FRAMES = 20
+FRAME_SECONDS = 3.0
+
+
+def percentile(values, q):
+    """q（0〜1）の位置の値（最近傍順位法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(q * len(ordered))) - 1]
+
+
+def make_fleet(size, first_work_no, seed=0):
+    """get-buses と同じ形の合成バス一覧を FRAMES コマ分作る（コマごとに少しずつ動かす）"""
+    rng = random.Random(seed)
+    buses = [{
+        'workNo': first_work_no + i,
+        'position': {
+            'latitude': CENTER[0] + rng.uniform(-SPREAD_DEG, SPREAD_DEG),
+            'longitude': CENTER[1] + rng.uniform(-SPREAD_DEG, SPREAD_DEG)
+        },
+        'routeNames': {'1': rng.choice(DESTINATIONS)},
+        'delayMinutes': rng.randint(-2, 10),
+        'passenger': rng.randint(0, 60),
+        'capacity': 60,
+        'occupancyStatus': rng.randint(1, 4)
+    } for i in range(size)]
+
+    frames = []
+    start = time.time()
+    for n in range(FRAMES):
+        frame = []
+        for bus in buses:
+            moved = dict(bus)
+            moved['position'] = {
+                'latitude': bus['position']['latitude'] + n * 0.0002,
+                'longitude': bus['position']['longitude'] + n * 0.0002
+            }
+            frame.append(moved)
+        frames.append((start + n * FRAME_SECONDS, frame))
+    return ReplaySource({None: frames})
+
+
+def timed(func, repeat):
+    """func を repeat 回呼び、1回ごとの所要時間（ミリ秒）を返す"""
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+
+def wait_until_quiet(replay, quiet=0.5, timeout=30.0):
+    """
+    再生サーバーへの呼び出しが quiet 秒途切れるまで待ち、それまでの呼び出し回数の合計を返す
+
+    締め切りを過ぎて取り残された get-bus が、次の計測の呼び出し数に混ざらないようにする。
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        before = sum(replay.calls.values())
+        time.sleep(quiet)
+        if sum(replay.calls.values()) == before:
+            break
+    return sum(replay.reset_calls().values())
+
+
+def use_condition(replay, source, latency):
+    """再生サーバーの記録と上流の遅さを差し替え、再生を最初からやり直す"""
+    replay.source = source
+    replay.latency = latency
+    replay.restart()
+
+
+def run_viewers(app, path, concurrency, total):
+    """concurrency 人の閲覧者が合わせて total 回 path を取得したときの応答時間（ミリ秒）と経過時間（秒）"""
+    durations = []
+    lock = threading.Lock()
+    per_viewer = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+
+    def viewer(count):
+        client = app.test_client()
+        local = []
+        for _ in range(count):
+            started = time.perf_counter()
+            response = client.get(path)
+            response.get_data()
+            local.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f"{path}: {response.status_code}")
+        with lock:
+            durations.extend(local)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(viewer, count) for count in per_viewer]:
+            future.result()
+    return durations, time.perf_counter() - started
+
+
+def main():
+    # 再生サーバーのアクセスログは出さない
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    replay = ReplayServer(make_fleet(FLEET_SIZES[0], 1), dictionary_dir=None)
+    server = make_server('127.0.0.1', REPLAY_PORT, replay.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='replay-server', daemon=True).start()
+
+    # 時刻表など web_map_app が相対パスで読むファイルのために、buskita/ で動かす
+    os.chdir(BUSKITA_DIR)
+    import web_map_app
+
+    path = '/api/bus_locations' + (f"?{QUERY}" if QUERY else '')
+    conditions = [(latency, fleet_size) for latency in LATENCIES for fleet_size in FLEET_SIZES]
+    # workNo を条件ごとに変え、前の条件の詳細キャッシュが効かないようにする
+    fleets = {condition: make_fleet(condition[1], n * 100000 + 1) for n, condition in enumerate(conditions)}
+
+    # 1. 取得と整形（更新スレッドが動き出す前に測り、上流の呼び出し数に混ざらないようにする）
+    fetch_results = {}
+    for latency, fleet_size in conditions:
+        use_condition(replay, fleets[(latency, fleet_size)], latency)
+        cold = timed(web_map_app.get_live_bus_data, 1)[0]
+        cold_calls = wait_until_quiet(replay)
+        warm = timed(web_map_app.get_live_bus_data, 5)
+        warm_calls = wait_until_quiet(replay) / 5
+        raw = web_map_app.get_live_bus_data()
+        wait_until_quiet(replay)
+        formatting = timed(lambda: web_map_app.filter_and_format_buses(raw), 20)
+        fetch_results[(latency, fleet_size)] = {
+            'fetch_cold_ms': cold,
+            'fetch_cold_upstream_calls': cold_calls,
+            'fetch_warm_p50_ms': percentile(warm, 0.5),
+            'fetch_warm_upstream_calls': warm_calls,
+            'format_p50_ms': percentile(formatting, 0.5),
+        }
+
+    # 2. /api/bus_locations（更新スレッドは動いたまま。上流の呼び出しは閲覧者数に関係なく一定のはず）
+    results = []
+    for n, (latency, fleet_size) in enumerate(conditions):
+        use_condition(replay, make_fleet(fleet_size, n * 100000 + 50001), latency)
+        # 初回は更新スレッドを起動して1回目の取得を待つ（最初のリクエストの待ち時間を計測に含めない）
+        web_map_app.bus_poller.get_snapshot()
+        web_map_app.bus_poller.refresh_once()
+        wait_until_quiet(replay)
+
+        for concurrency in CONCURRENCY:
+            replay.reset_calls()
+            durations, elapsed = run_viewers(web_map_app.app, path, concurrency, REQUESTS)
+            upstream_calls = sum(replay.reset_calls().values())
+            result = {
+                'fleet_size': fleet_size,
+                'latency_ms': latency * 1000,
+                'concurrency': concurrency,
+                'requests': len(durations),
+                'p50_ms': percentile(durations, 0.5),
+                'p99_ms': percentile(durations, 0.99),
+                'requests_per_sec': len(durations) / elapsed if elapsed else None,
+                'upstream_calls_per_request': upstream_calls / len(durations),
+            }
+            result.update(fetch_results[(latency, fleet_size)])
+            results.append(result)
+            print(f"台数 {fleet_size:5d} / 上流 {latency * 1000:5.0f}ms / 同時 {concurrency:3d}: "
+                  f"p50 {result['p50_ms']:7.2f}ms  p99 {result['p99_ms']:7.2f}ms  "
+                  f"{result['requests_per_sec']:8.1f} req/s  上流呼び出し {result['upstream_calls_per_request']:.3f}/req  | "
+                  f"取得 初回 {result['fetch_cold_ms']:7.1f}ms（{result['fetch_cold_upstream_calls']}回） "
+                  f"2回目以降 {result['fetch_warm_p50_ms']:7.1f}ms（{result['fetch_warm_upstream_calls']:g}回）  "
+                  f"整形 {result['format_p50_ms']:6.2f}ms")
+
+    web_map_app.bus_poller.stop()
+    wait_until_quiet(replay)
+    web_map_app.bus_fetch_engine.shutdown()
+    server.shutdown()
+    if OUTPUT:
+        with open(OUTPUT, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {OUTPUT}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,12 @@
-import requests
+import os
+import sys
 import json
-import time
-from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buskita_client import get_client
+from snapshot_archive import SnapshotArchive
 
 def get_bus_location(work_no='48385', site_id=9, language=1):
-    # APIのエンドポイント
-    url = 'https://api.buskita.com/get-bus'
-    
-    # リクエストヘッダー
-    headers = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'ja',
-        'Content-Type': 'application/json',
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.3 Safari/605.1.15'
-    }
-    
     # リクエストボディ
     data = {
         'language': language,
@@ -23,8 +15,8 @@ def get_bus_location(work_no='48385', site_id=9, language=1):
     }
     
     try:
-        # POSTリクエストを送信
-        response = requests.post(url, headers=headers, json=data)
+        # POSTリクエストを送信（共通クライアントの接続を再利用する）
+        response = get_client().post('get-bus', data)
         
         if response.status_code == 200:
             return response.json()
@@ -44,15 +36,12 @@ def main():
         location_data = get_bus_location()
         
         if location_data:
-            # 現在時刻を取得
-            timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            
-            # データをファイルに保存
-            filename = f'bus_location_{timestamp}.json'
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(location_data, f, ensure_ascii=False, indent=2)
+            # データをアーカイブに追記（日付ごとの圧縮セグメントにまとめる）
+            archive = SnapshotArchive('bus_location')
+            archive.append(location_data, site=9, endpoint='get-bus', workNo='48385')
+            archive.close()
             
-            print(f"Location data saved to {filename}")
+            print(f"Location data saved to {archive.directory}")
         # print a formatted json
         print(json.dumps(location_data, indent=2, ensure_ascii=False))
         
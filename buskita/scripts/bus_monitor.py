@@ -1,62 +1,86 @@
-import requests
-import json
+import os
+import sys
 import time
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buskita_client import get_client
+from site_monitor import SiteMonitor, SiteSchedule
+from snapshot_archive import SnapshotArchive
+
+# 監視するサイトID（"9:10" のように書くとそのサイトだけ取得間隔を変えられる）
+MONITOR_SITES = os.environ.get('MONITOR_SITES', '1,3,9,12,15')
+# 各サイトの取得間隔（秒）
+MONITOR_INTERVAL = float(os.environ.get('MONITOR_INTERVAL', '30'))
+# 同時に取得するサイト数と、全サイト合計の 1秒あたりのリクエスト数の上限
+MONITOR_WORKERS = int(os.environ.get('MONITOR_WORKERS', '8'))
+MONITOR_RATE_LIMIT = float(os.environ.get('MONITOR_RATE_LIMIT', '2'))
+
+
+def parse_sites(spec, default_interval):
+    """'1,3,9:10' の形の指定を SiteSchedule のリストにする"""
+    sites = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        site_id, _, interval = item.partition(':')
+        sites.append(SiteSchedule(int(site_id), float(interval) if interval else default_interval))
+    return sites
+
+
 def monitor_buses():
-    """リアルタイムバス監視"""
-    url = "https://api.buskita.com/get-buses"
-    headers = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'ja',
-        'Content-Type': 'application/json',
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
-    }
-    
-    # 複数のサイトIDを監視
-    sites_to_monitor = [1, 3, 9, 12, 15]  # 主要サイト
-    
-    while True:
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print(f"
-{timestamp} - バス監視中...")
-        
-        total_buses = 0
-        for site_id in sites_to_monitor:
-            try:
-                response = requests.post(url, headers=headers, json={
-                    'language': 1,
-                    'siteId': site_id
-                })
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    buses = data.get('buses', [])
-                    bus_count = len(buses)
-                    total_buses += bus_count
-                    
-                    if bus_count > 0:
-                        print(f"🚌 サイト{site_id}: {bus_count}台運行中")
-                        
-                        # バス詳細を記録
-                        filename = f'active_buses_site{site_id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-                        with open(filename, 'w', encoding='utf-8') as f:
-                            json.dump(data, f, ensure_ascii=False, indent=2)
-                        print(f"   データ保存: {filename}")
-                    else:
-                        print(f"📍 サイト{site_id}: 0台")
-                
-                time.sleep(1)  # サイト間の間隔
-                
-            except Exception as e:
-                print(f"❌ サイト{site_id}でエラー: {e}")
-        
-        print(f"合計: {total_buses}台")
-        
-        if total_buses > 0:
-            print("🎯 運行中のバス発見！監視を継続します...")
-        
-        time.sleep(30)  # 30秒間隔で監視
+    """リアルタイムバス監視（サイトごとに固定レートで並行取得）"""
+    client = get_client()
+    sites = parse_sites(MONITOR_SITES, MONITOR_INTERVAL)
+    # 取得した応答は1件1ファイルにせず、日付ごとの圧縮セグメントに追記する
+    archive = SnapshotArchive('bus_monitor')
+
+    def fetch(site_id):
+        return client.post_json('get-buses', {
+            'language': 1,
+            'siteId': site_id
+        })
+
+    def save(site_id, data, fetched_at):
+        buses = data.get('buses', [])
+        timestamp = datetime.fromtimestamp(fetched_at).strftime('%Y-%m-%d %H:%M:%S')
+        if not buses:
+            print(f"{timestamp} 📍 サイト{site_id}: 0台")
+            return
+        print(f"{timestamp} 🚌 サイト{site_id}: {len(buses)}台運行中")
+
+        # バス詳細を記録
+        archive.append(data, ts=fetched_at, site=site_id, endpoint='get-buses')
+
+    monitor = SiteMonitor(
+        sites,
+        fetch_func=fetch,
+        on_result=save,
+        max_workers=MONITOR_WORKERS,
+        rate_limit=MONITOR_RATE_LIMIT,
+        burst=MONITOR_WORKERS
+    )
+    print(f"{len(sites)}サイトを監視します: " + ', '.join(f"{s.site_id}（{s.interval:g}秒ごと）" for s in sites))
+    monitor.start()
+
+    try:
+        while True:
+            time.sleep(MONITOR_INTERVAL)
+            total_buses = sum(stats.last_count or 0 for stats in monitor.stats.values())
+            errors = sum(stats.errors for stats in monitor.stats.values())
+            skipped = sum(stats.skipped for stats in monitor.stats.values())
+            print(f"\n{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - 合計: {total_buses}台"
+                  f"（エラー累計 {errors} 回、見送り累計 {skipped} 回）")
+            if total_buses > 0:
+                print("🎯 運行中のバス発見！監視を継続します...")
+    except KeyboardInterrupt:
+        print("\n監視を終了します")
+    finally:
+        monitor.stop()
+        archive.close()
+        print(f"データ保存先: {archive.directory}")
+
 
 if __name__ == '__main__':
     monitor_buses()
@@ -4,28 +4,47 @@ buskita.com API 使用ガイド
 PlaywrightによるWebスクレイピングで発見された10個のAPIエンドポイントの詳細な使用方法
 """
 
-import requests
+import os
+import sys
 import json
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buskita_client import API_BASE_URL, BuskitaClient
+from dictionary_cache import DictionaryCache
+
 class BuskitaAPIClient:
     """buskita.com APIクライアント"""
     
     def __init__(self):
-        self.base_url = "https://api.buskita.com"
+        self.base_url = API_BASE_URL
         self.headers = {
             'Accept': 'application/json, text/plain, */*',
             'Accept-Language': 'ja',
             'Content-Type': 'application/json',
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
         }
+        self.client = BuskitaClient(base_url=self.base_url, headers=self.headers)
+        # (siteId, 言語) → 辞書キャッシュ。静的な辞書はバージョンが変わったときだけ取得する
+        self._dictionaries: Dict[tuple, DictionaryCache] = {}
+    
+    def _get_dictionary(self, name: str, site_id: int = 9, language: int = 1) -> Optional[Dict[str, Any]]:
+        """辞書をローカルキャッシュ経由で取得（バージョンが変わっていなければ通信しない）"""
+        cache = self._dictionaries.get((site_id, language))
+        if cache is None:
+            cache = DictionaryCache(self.client, site_id=site_id, language=language)
+            self._dictionaries[(site_id, language)] = cache
+        try:
+            return cache.get(name)
+        except Exception as e:
+            print(f"リクエストエラー: {str(e)}")
+            return None
     
     def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """APIリクエストを実行"""
         try:
-            url = f"{self.base_url}/{endpoint}"
-            response = requests.post(url, headers=self.headers, json=data)
+            response = self.client.post(endpoint, data)
             
             if response.status_code == 200:
                 return response.json()
@@ -52,7 +71,7 @@ class BuskitaAPIClient:
             for company in companies:
                 print(f"{company['name']} - {company['shortName']}")
         """
-        result = self._make_request('get-companies-dictionary', {'language': language})
+        result = self._get_dictionary('companies', language=language)
         return result['companiesDictionary'] if result else None
     
     # ===== 2. ランドマーク情報 =====
@@ -74,10 +93,7 @@ class BuskitaAPIClient:
                 lng = landmark['position']['longitude']
                 print(f"{landmark['name']}: ({lat}, {lng})")
         """
-        result = self._make_request('get-landmarks-dictionary', {
-            'language': language, 
-            'siteId': site_id
-        })
+        result = self._get_dictionary('landmarks', site_id, language)
         return result['landmarksDictionary'] if result else None
     
     # ===== 3. 重要なお知らせ =====
@@ -146,10 +162,7 @@ class BuskitaAPIClient:
             for group in groups:
                 print(f"グループ{group['id']}: {group['group_name']}")
         """
-        result = self._make_request('get-busstops-group', {
-            'language': language, 
-            'siteId': site_id
-        })
+        result = self._get_dictionary('busstops_group', site_id, language)
         return result['groups'] if result else None
     
     # ===== 6. バス停グルーピング =====
@@ -169,10 +182,7 @@ class BuskitaAPIClient:
             for item in groupings:
                 print(f"会社:{item['company_no']}, バス停:{item['bus_stop_no']}, グループ:{item['group_id']}")
         """
-        result = self._make_request('get-busstops-grouping', {
-            'language': language, 
-            'siteId': site_id
-        })
+        result = self._get_dictionary('busstops_grouping', site_id, language)
         return result['groupings'] if result else None
     
     # ===== 7. メンテナンス情報 =====
@@ -213,10 +223,7 @@ class BuskitaAPIClient:
         Returns:
             List[Dict]: のりば別名のリスト
         """
-        result = self._make_request('get-noriba-alias', {
-            'language': language, 
-            'siteId': site_id
-        })
+        result = self._get_dictionary('noriba_alias', site_id, language)
         return result['aliases'] if result else None
     
     # ===== 9. UI辞書バージョン =====
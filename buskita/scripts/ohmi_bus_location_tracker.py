@@ -1,9 +1,14 @@
+import os
+import sys
 import requests
 import json
 import time
 from datetime import datetime
 from urllib.parse import quote
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapshot_archive import SnapshotArchive
+
 def get_ohmi_bus_location(from_station="南草津駅【近江鉄道・湖国バス】", to_station="松ヶ丘五丁目【近江鉄道・湖国バス】", 
                          route_name="南草津飛島線：パナソニック【近江鉄道・湖国バス】", departure_time="18:39"):
     """
@@ -72,13 +77,10 @@ def get_ohmi_bus_location(from_station="南草津駅【近江鉄道・湖国バ
         # レスポンスをJSONとして解析
         result = response.json()
         
-        # 現在時刻を取得
-        current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        
-        # 結果をJSONファイルとして保存
-        output_file = f"ohmi_bus_location_{current_time}.json"
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
+        # 結果をアーカイブに追記（日付ごとの圧縮セグメントにまとめる）
+        archive = SnapshotArchive('ohmi_bus_location')
+        archive.append(result, route=route_name, departure=departure_time)
+        archive.close()
             
         return result
         
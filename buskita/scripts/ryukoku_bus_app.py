@@ -5,11 +5,19 @@
 学生向けバス遅延・発車時刻確認システム
 """
 
-import requests
-import sqlite3
+import os
+import sys
+import atexit
 from datetime import datetime, timedelta
 import json
-import math
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buskita_client import API_BASE_URL, BuskitaClient
+from departure_index import DepartureIndex
+from dictionary_cache import DEFAULT_CACHE_DIR
+from geo import GeofenceEngine, haversine
+from history_db import BusHistoryWriter
+from holiday_calendar import HolidayCalendar
 
 # 龍谷大学バス路線定義
 RYUKOKU_BUS_ROUTES = {
@@ -40,50 +48,55 @@ RYUKOKU_BUS_ROUTES = {
     }
 }
 
+# 龍谷大学瀬田キャンパス（この半径内にいるバスをキャンパス内とみなす）
+CAMPUS = {"name": "龍谷大学瀬田キャンパス", "lat": 34.9445, "lng": 135.9134, "radius_km": 0.2}
+
+# 曜日区分（timetable.json のキー）→ RYUKOKU_BUS_ROUTES のスケジュール名
+SCHEDULE_NAMES = {
+    'weekdays': '平日',
+    'saturdays': '土曜',
+    'holidays': '日祝'
+}
+
 class RyukokuBusApp:
     def __init__(self):
-        self.api_base = "https://api.buskita.com"
+        self.api_base = API_BASE_URL
         self.site_id = 9  # 滋賀帝産バス
         self.db_path = "ryukoku_bus.db"
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X)',
             'Accept': 'application/json'
         }
+        self.client = BuskitaClient(base_url=self.api_base, headers=self.headers)
+        self.departures = DepartureIndex.from_schedule_map(
+            {route: info['schedule'] for route, info in RYUKOKU_BUS_ROUTES.items()}
+        )
+        self.campus_fence = GeofenceEngine([CAMPUS])
+        self.calendar = HolidayCalendar(
+            lambda: self.client.post_json('get-holidays', {'language': 1, 'siteId': self.site_id}).get('holidays', {}),
+            cache_file=os.path.join(DEFAULT_CACHE_DIR, f"site{self.site_id}_holidays.json")
+        )
         self.init_database()
         
     def init_database(self):
-        """データベース初期化"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # バス位置履歴テーブル
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bus_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                work_no INTEGER,
-                latitude REAL,
-                longitude REAL,
-                speed REAL,
-                update_time TEXT,
-                recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        """データベース初期化（bus_history とそのインデックスは BusHistoryWriter が作る）"""
+        # 接続は1本だけ開いたまま使い回し、位置情報はまとめて書き込む
+        self.history = BusHistoryWriter(self.db_path)
+        atexit.register(self.history.close)
         
         # 遅延記録テーブル
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS delay_records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                route_name TEXT,
-                scheduled_time TEXT,
-                actual_time TEXT,
-                delay_minutes INTEGER,
-                date DATE,
-                weather TEXT
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        with self.history.conn as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS delay_records (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    route_name TEXT,
+                    scheduled_time TEXT,
+                    actual_time TEXT,
+                    delay_minutes INTEGER,
+                    date DATE,
+                    weather TEXT
+                )
+            ''')
     
     def get_current_buses(self):
         """現在運行中のバスを取得"""
@@ -92,12 +105,11 @@ class RyukokuBusApp:
         
         # NOTE: get-busesは存在しないため、APIドキュメントに基づきPOSTリクエストに変更。
         #       動作確認のため、一時的に get-companies-dictionary を使用する。
-        url = f"{self.api_base}/get-companies-dictionary"
         payload = {'language': 1}
 
         try:
             # response = requests.get(url, params=params, headers=self.headers)
-            response = requests.post(url, json=payload, headers=self.headers)
+            response = self.client.post('get-companies-dictionary', payload)
             response.raise_for_status()
             # APIのレスポンス形式が異なるため、ここでは空のリストを返す
             # return response.json()
@@ -109,19 +121,7 @@ class RyukokuBusApp:
     
     def calculate_distance(self, lat1, lng1, lat2, lng2):
         """2点間の距離を計算（km）"""
-        R = 6371  # 地球の半径（km）
-        
-        lat1_rad = math.radians(lat1)
-        lat2_rad = math.radians(lat2)
-        delta_lat = math.radians(lat2 - lat1)
-        delta_lng = math.radians(lng2 - lng1)
-        
-        a = (math.sin(delta_lat/2) * math.sin(delta_lat/2) + 
-             math.cos(lat1_rad) * math.cos(lat2_rad) * 
-             math.sin(delta_lng/2) * math.sin(delta_lng/2))
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        
-        return R * c
+        return haversine(lat1, lng1, lat2, lng2)
     
     def is_bus_at_campus(self, bus, campus_coords, threshold_km=0.2):
         """バスがキャンパス付近にいるかチェック"""
@@ -133,21 +133,17 @@ class RyukokuBusApp:
         return distance <= threshold_km
     
     def find_buses_near_campus(self):
-        """キャンパス周辺のバスを検索"""
+        """キャンパス周辺のバスを検索（全バスの距離を1回の配列演算でまとめて計算する）"""
         buses = self.get_current_buses()
-        campus_coords = (34.9445, 135.9134)  # 龍谷大学瀬田キャンパス
+        if not buses:
+            return []
+        result = self.campus_fence.evaluate(buses)
         
         nearby_buses = []
-        for bus in buses:
-            if self.is_bus_at_campus(bus, campus_coords):
-                # 追加情報を計算
-                distance = self.calculate_distance(
-                    bus['lat'], bus['lng'],
-                    campus_coords[0], campus_coords[1]
-                )
-                
+        for i, bus in enumerate(buses):
+            if result.inside_radius[i, 0]:
                 bus_info = bus.copy()
-                bus_info['distance_to_campus'] = round(distance * 1000)  # メートル単位
+                bus_info['distance_to_campus'] = round(float(result.distances_km[i, 0]) * 1000)  # メートル単位
                 bus_info['is_stopped'] = bus.get('speed', 0) == 0
                 
                 nearby_buses.append(bus_info)
@@ -208,11 +204,15 @@ class RyukokuBusApp:
         
         return None
     
+    def get_schedule_name(self, when=None):
+        """今日（または指定日）に使うスケジュール名（平日・土曜・日祝）"""
+        return SCHEDULE_NAMES[self.calendar.day_type(when)]
+    
     def get_next_buses(self, route_name=None):
         """次のバスの時刻表"""
         current_time = datetime.now()
-        current_hour = current_time.hour
-        current_minute = current_time.minute
+        minute_of_day = current_time.hour * 60 + current_time.minute
+        schedule_name = self.get_schedule_name(current_time)
         
         next_buses = []
         
@@ -221,51 +221,25 @@ class RyukokuBusApp:
         for route in routes_to_check:
             if route not in RYUKOKU_BUS_ROUTES:
                 continue
-                
-            route_info = RYUKOKU_BUS_ROUTES[route]
-            
-            # 平日スケジュールを使用（実際は曜日判定が必要）
-            schedule = route_info['schedule'].get('平日', [])
             
-            for time_str in schedule:
-                try:
-                    bus_hour, bus_minute = map(int, time_str.split(':'))
-                    
-                    # 現在時刻より後のバスを検索
-                    if bus_hour > current_hour or (bus_hour == current_hour and bus_minute > current_minute):
-                        minutes_until = (bus_hour - current_hour) * 60 + (bus_minute - current_minute)
-                        
-                        next_buses.append({
-                            'route': route,
-                            'scheduled_time': time_str,
-                            'minutes_until': minutes_until
-                        })
-                except ValueError:
-                    continue
+            for bus in self.departures.upcoming(route, schedule_name, minute_of_day):
+                next_buses.append({
+                    'route': route,
+                    'scheduled_time': bus['time'],
+                    'minutes_until': bus['minutes_until']
+                })
         
         # 時間順にソート
         next_buses.sort(key=lambda x: x['minutes_until'])
         return next_buses
     
     def save_bus_position(self, bus):
-        """バス位置をデータベースに保存"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO bus_history 
-            (work_no, latitude, longitude, speed, update_time)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
-            bus.get('workNo'),
-            bus.get('lat'),
-            bus.get('lng'),
-            bus.get('speed'),
-            bus.get('updateTime')
-        ))
-        
-        conn.commit()
-        conn.close()
+        """バス位置をデータベースに保存（ためておき、しきい値を超えたらまとめて書き込む）"""
+        self.history.add(bus)
+    
+    def save_bus_positions(self, buses):
+        """1回の取得分のバス位置をまとめて保存"""
+        self.history.add_many(buses)
     
     def get_campus_bus_status(self):
         """キャンパスバス状況の総合情報"""
@@ -274,10 +248,11 @@ class RyukokuBusApp:
         
         # 遅延状況を計算
         current_time = datetime.now().strftime("%H:%M")
+        schedule_name = self.get_schedule_name()
         delay_info = {}
         
         for route_name, route_info in RYUKOKU_BUS_ROUTES.items():
-            scheduled_times = route_info['schedule'].get('平日', [])
+            scheduled_times = route_info['schedule'].get(schedule_name, [])
             delays = self.calculate_delay(current_time, scheduled_times)
             if delays:
                 delay_info[route_name] = delays
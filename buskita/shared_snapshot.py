@@ -0,0 +1,117 @@
+"""
+gunicornワーカー間でのスナップショット共有
+
+ファイルロック（flock）を取れた1プロセスだけが上流APIを取得し、
+結果をファイルへアトミックに書き出す。他のワーカーはそのファイルが
+差し替わったときだけ読み直すので、上流APIへのアクセスはワーカー数に
+関係なく1周期1回になる。取得担当のプロセスが落ちるとロックは自動で
+解放され、次の周期で別のワーカーが引き継ぐ。
+"""
+
+import json
+import os
+import tempfile
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows など flock が使えない環境では常に自分が取得担当になる
+    fcntl = None
+
+from bus_snapshot import BusSnapshot
+
+
+def atomic_write_bytes(path: str, data: bytes):
+    """一時ファイルに書いてから rename し、読み手が書きかけのファイルを見ないようにする"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp は所有者のみ読める権限で作るので、通常のファイルと同じ権限に戻す
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class SharedSnapshotStore:
+    """取得担当の選出と、スナップショットファイルの読み書きを行う"""
+
+    def __init__(self, directory: str, name: str):
+        """
+        Args:
+            directory (str): 共有ファイルを置くディレクトリ（全ワーカーで同じ場所）
+            name (str): ファイル名の接頭辞（例: 'buskita_snapshot_site9'）
+        """
+        self.path = os.path.join(directory, f"{name}.json")
+        self.lock_path = os.path.join(directory, f"{name}.lock")
+        self.is_leader = False
+        self._lock_file = None
+        self._last_stat = None
+
+    def try_acquire_leader(self) -> bool:
+        """取得担当のロックを試みる（取れていればそのまま保持し続ける）"""
+        if self.is_leader:
+            return True
+        if fcntl is None:
+            self.is_leader = True
+            return True
+
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self._lock_file = lock_file
+        self.is_leader = True
+        print(f"[pid {os.getpid()}] 上流APIの取得担当になりました。")
+        return True
+
+    def publish(self, snapshot: BusSnapshot):
+        """
+        スナップショットを共有ファイルへ書き出す（取得担当のみ呼ぶ）
+
+        上流の生の応答（raw_buses）は取得担当の中でしか使わないので書き出さない。
+        """
+        payload = {
+            'version': snapshot.version,
+            'buses': snapshot.buses,
+            'is_stale': snapshot.is_stale,
+            'fetched_at': snapshot.fetched_at
+        }
+        data = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        atomic_write_bytes(self.path, data)
+
+    def load_if_changed(self) -> Optional[BusSnapshot]:
+        """共有ファイルが差し替わっていれば読み込む。変化がなければ None"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        # rename で差し替えるので inode と更新時刻が変わったときだけ読めばよい
+        stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stat_key == self._last_stat:
+            return None
+
+        try:
+            with open(self.path, 'rb') as f:
+                payload = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            print(f"共有スナップショットの読み込みに失敗しました: {e}")
+            return None
+
+        self._last_stat = stat_key
+        return BusSnapshot(
+            version=payload.get('version', 0),
+            buses=payload.get('buses', []),
+            is_stale=payload.get('is_stale', True),
+            fetched_at=payload.get('fetched_at', 0.0)
+        )
@@ -0,0 +1,182 @@
+"""
+複数サイトの並行監視
+
+サイトごとに取得間隔を持たせ、1本のスケジューラスレッドが「次に取得する時刻」の
+早い順に取り出してスレッドプールへ渡す。取得時刻は 開始時刻 + ずらし + n × 間隔 で
+決めるので、取得にかかった時間で周期がずれていかない。サイトの取得時刻は間隔の中で
+均等にずらし、全サイトが同じ瞬間に api.buskita.com へ集中しないようにする。
+上流へのリクエスト数はトークンバケットで全サイト合計の上限に抑える。
+"""
+
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class RateLimiter:
+    """トークンバケット方式のリクエスト数の上限（スレッドセーフ）"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Args:
+            rate (float): 1秒あたりに許可するリクエスト数（0以下なら制限しない）
+            burst (int): まとめて許可できるリクエスト数の上限
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        トークンを1つ取る（足りなければたまるまで待つ）
+
+        Returns:
+            bool: timeout までに取れなかった場合は False
+        """
+        if self.rate <= 0:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+@dataclass
+class SiteSchedule:
+    """1サイト分の取得予定"""
+    site_id: int
+    interval: float
+    # 開始時刻からのずらし（秒）。None なら間隔の中で均等に割り振る
+    offset: Optional[float] = None
+
+
+@dataclass
+class SiteStats:
+    """1サイト分の取得結果の集計"""
+    fetched: int = 0
+    errors: int = 0
+    # 前回の取得がまだ終わっていなかったために見送った回数
+    skipped: int = 0
+    last_count: Optional[int] = None
+    last_fetched_at: Optional[float] = None
+    last_duration: Optional[float] = None
+
+
+class SiteMonitor:
+    """複数サイトのバス一覧を、サイトごとの固定レートで並行して取得する"""
+
+    def __init__(self,
+                 sites: Iterable[SiteSchedule],
+                 fetch_func: Callable[[int], Dict[str, Any]],
+                 on_result: Callable[[int, Dict[str, Any], float], None],
+                 max_workers: int = 8,
+                 rate_limit: float = 0.0,
+                 burst: int = 1):
+        """
+        Args:
+            sites: サイトごとの取得予定
+            fetch_func: サイトIDを受け取り、get-buses の応答（JSON）を返す関数
+            on_result: (サイトID, 応答, 取得時刻 UNIX秒) を受け取る関数（ワーカースレッドから呼ばれる）
+            max_workers (int): 同時に取得するサイト数の上限
+            rate_limit (float): 全サイト合計の 1秒あたりのリクエスト数の上限（0 なら制限しない）
+            burst (int): rate_limit を超えてまとめて送れるリクエスト数
+        """
+        self.sites = list(sites)
+        self.fetch_func = fetch_func
+        self.on_result = on_result
+        self.limiter = RateLimiter(rate_limit, burst)
+        self.stats: Dict[int, SiteStats] = {site.site_id: SiteStats() for site in self.sites}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='site-monitor')
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """スケジューラスレッドを起動する（2回目以降の呼び出しは何もしない）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='site-monitor-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self, wait: bool = True):
+        """スケジューラを止め、実行中の取得の終了を待つ"""
+        self._stop.set()
+        if self._thread is not None and wait:
+            self._thread.join()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _initial_ticks(self, start: float) -> List[Tuple[float, int, int, SiteSchedule]]:
+        """各サイトの最初の取得時刻を (時刻, 回数, 並び順, 予定) のヒープにする"""
+        heap = []
+        count = len(self.sites)
+        for order, site in enumerate(self.sites):
+            offset = site.offset if site.offset is not None else site.interval * order / count
+            heap.append((start + offset, 0, order, site))
+        heapq.heapify(heap)
+        return heap
+
+    def _run(self):
+        """取得時刻の早いサイトから順に、時刻になったらプールへ渡す"""
+        start = time.monotonic()
+        heap = self._initial_ticks(start)
+        while heap and not self._stop.is_set():
+            tick, n, order, site = heap[0]
+            delay = tick - time.monotonic()
+            if delay > 0:
+                if self._stop.wait(delay):
+                    break
+                continue
+            heapq.heappop(heap)
+
+            with self._lock:
+                busy = site.site_id in self._in_flight
+                if not busy:
+                    self._in_flight.add(site.site_id)
+            if busy:
+                # 前回の取得が周期より長引いている場合は、重ねて送らずにこの回を見送る
+                self.stats[site.site_id].skipped += 1
+            else:
+                self._executor.submit(self._fetch, site.site_id)
+
+            # 次の取得時刻は開始時刻からの周期で決める（遅れた分は取り戻さず、次の周期に合わせる）
+            base = tick - n * site.interval
+            n += 1
+            now = time.monotonic()
+            if base + n * site.interval < now:
+                n = int((now - base) // site.interval) + 1
+            heapq.heappush(heap, (base + n * site.interval, n, order, site))
+
+    def _fetch(self, site_id: int):
+        """1サイト分を取得して on_result に渡す（ワーカースレッドで実行）"""
+        stats = self.stats[site_id]
+        try:
+            self.limiter.acquire()
+            started = time.monotonic()
+            data = self.fetch_func(site_id)
+            stats.last_duration = time.monotonic() - started
+            stats.last_fetched_at = time.time()
+            stats.last_count = len(data.get('buses') or [])
+            stats.fetched += 1
+            self.on_result(site_id, data, stats.last_fetched_at)
+        except Exception as e:
+            stats.errors += 1
+            print(f"❌ サイト{site_id}でエラー: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(site_id)
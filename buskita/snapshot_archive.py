@@ -0,0 +1,236 @@
+"""
+取得した応答の追記専用アーカイブ
+
+監視・追跡スクリプトが取得のたびに整形済みJSONファイルを1つずつ作っていたのをやめ、
+1回の取得を1行のJSON（{'ts': 取得時刻, ...付帯情報, 'data': 応答}）にして、
+日付（日本時間）ごとのディレクトリにある gzip のセグメントへ追記する。
+
+    {root}/{stream}/2025-07-01/index.json              セグメントごとの時間範囲
+                               093000.jsonl.gz         09:30:00 から書き始めたセグメント
+                               103000.jsonl.gz
+
+追記はためておいた行を1つの gzip メンバーに圧縮してファイル末尾に足すだけなので、
+書きかけのメンバーが残っても、それより前の記録は読み出せる。時間範囲の読み出しは
+index.json で対象のセグメントを絞り、古い順に先頭から読むだけで済む。
+1つの stream に書き込むのは1プロセスだけとする。
+"""
+
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from departure_index import JST
+from observation_store import partition_name
+from shared_snapshot import atomic_write_bytes
+
+DEFAULT_ARCHIVE_DIR = os.environ.get(
+    'BUSKITA_SNAPSHOT_ARCHIVE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive', 'snapshots')
+)
+INDEX_FILE = 'index.json'
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+
+class SnapshotArchive:
+    """1つの stream（記録の種類）に応答を追記し、時間範囲で読み出す"""
+
+    def __init__(self,
+                 stream: str,
+                 root: str = DEFAULT_ARCHIVE_DIR,
+                 flush_records: int = 100,
+                 flush_interval: float = 60.0,
+                 segment_max_records: int = 10000,
+                 segment_max_seconds: float = 60 * 60):
+        """
+        Args:
+            stream (str): 記録の種類（'bus_monitor' など。ディレクトリ名になる）
+            root (str): アーカイブを置くディレクトリ
+            flush_records (int): この件数たまったら書き込む
+            flush_interval (float): 最後の書き込みからこの秒数が過ぎたら書き込む
+            segment_max_records (int): 1セグメントの最大件数（超えたら次のセグメントに移る）
+            segment_max_seconds (float): 1セグメントに入れる時間の長さ（秒）
+        """
+        self.stream = stream
+        self.directory = os.path.join(root, stream)
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.segment_max_records = segment_max_records
+        self.segment_max_seconds = segment_max_seconds
+        self._pending: List[Dict[str, Any]] = []
+        self._last_flush = time.monotonic()
+        # 日付 → セグメントの一覧（書き込んだ日付だけ持つ）
+        self._indexes: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def append(self, data: Any, ts: Optional[float] = None, **meta):
+        """
+        1回分の応答をためる（しきい値を超えたら書き込む）
+
+        Args:
+            data: 応答（JSONにできるもの）
+            ts (float): 取得時刻（UNIX秒、省略時は現在時刻）
+            **meta: 一緒に残す付帯情報（site=9, endpoint='get-buses' など）
+        """
+        record = {'ts': time.time() if ts is None else ts}
+        record.update(meta)
+        record['data'] = data
+        with self._lock:
+            self._pending.append(record)
+            if len(self._pending) >= self.flush_records or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def flush(self):
+        """ためている記録をすべて書き込む"""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        """
+        残りを書き込む
+
+        書き込み中のセグメントは閉じない。取得のたびに起動するスクリプトが毎回 close() しても、
+        次に開いたときは同じセグメントに追記を続け、件数か時間の上限に達したときだけ次に移る。
+        """
+        self.flush()
+
+    def _flush_locked(self):
+        """ロックを持った状態で、ためた分を日付ごと・セグメントごとにまとめて書き込む"""
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        records, self._pending = self._pending, []
+
+        batch: List[Dict[str, Any]] = []
+        for record in records:
+            if batch and not self._fits(batch, record):
+                self._write_batch(batch)
+                batch = []
+            batch.append(record)
+        self._write_batch(batch)
+
+    def _fits(self, batch: List[Dict[str, Any]], record: Dict[str, Any]) -> bool:
+        """record を batch と同じセグメントに入れてよいか"""
+        first = batch[0]['ts']
+        return (partition_name(record['ts']) == partition_name(first)
+                and len(batch) < self.segment_max_records
+                and record['ts'] - first < self.segment_max_seconds)
+
+    def _write_batch(self, batch: List[Dict[str, Any]]):
+        """同じ日付の記録を、書き込み中のセグメント（入りきらなければ新しいセグメント）に追記する"""
+        day = partition_name(batch[0]['ts'])
+        segments = self._load_index_for_write(day)
+        segment = segments[-1] if segments else None
+        if segment is None or segment.get('closed') or not self._can_extend(segment, batch):
+            if segment is not None and not segment.get('closed'):
+                segment['closed'] = True
+            segment = {
+                'file': self._segment_name(day, batch[0]['ts'], segments),
+                'start': batch[0]['ts'], 'end': batch[0]['ts'], 'records': 0, 'bytes': 0
+            }
+            segments.append(segment)
+
+        lines = ''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n' for record in batch)
+        member = gzip.compress(lines.encode('utf-8'))
+        segment['start'] = min(segment['start'], min(record['ts'] for record in batch))
+        segment['end'] = max(segment['end'], max(record['ts'] for record in batch))
+        segment['records'] += len(batch)
+        segment['bytes'] += len(member)
+
+        # 索引を先に更新しておく（途中で止まっても、索引の範囲が実際より狭くなることはない）
+        self._write_index(day, segments)
+        with open(os.path.join(self.directory, day, segment['file']), 'ab') as f:
+            f.write(member)
+
+    def _can_extend(self, segment: Dict[str, Any], batch: List[Dict[str, Any]]) -> bool:
+        """書き込み中のセグメントに batch を追記してよいか"""
+        return (segment['records'] + len(batch) <= self.segment_max_records
+                and batch[-1]['ts'] - segment['start'] < self.segment_max_seconds)
+
+    @staticmethod
+    def _segment_name(day: str, ts: float, segments: List[Dict[str, Any]]) -> str:
+        """書き始めの時刻からセグメントのファイル名を決める（同じ秒に作った場合は連番を付ける）"""
+        base = datetime.fromtimestamp(ts, JST).strftime('%H%M%S')
+        used = {segment['file'] for segment in segments}
+        name, n = base + SEGMENT_SUFFIX, 1
+        while name in used:
+            name = f"{base}-{n}{SEGMENT_SUFFIX}"
+            n += 1
+        return name
+
+    def _load_index_for_write(self, day: str) -> List[Dict[str, Any]]:
+        """書き込み用に日付の索引を読む（書きかけで止まったセグメントには追記しない）"""
+        segments = self._indexes.get(day)
+        if segments is None:
+            segments = self.segments_for_day(day)
+            if segments and not segments[-1].get('closed'):
+                last = segments[-1]
+                path = os.path.join(self.directory, day, last['file'])
+                actual = os.path.getsize(path) if os.path.exists(path) else 0
+                if actual != last['bytes']:
+                    # 前回の書き込みが途中で止まっている。そこまでで閉じて、次からは新しいセグメントに書く
+                    last['bytes'] = actual
+                    last['closed'] = True
+            self._indexes[day] = segments
+        return segments
+
+    def _write_index(self, day: str, segments: List[Dict[str, Any]]):
+        """日付の索引を書き換える"""
+        data = json.dumps({'segments': segments}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        atomic_write_bytes(os.path.join(self.directory, day, INDEX_FILE), data)
+
+    def days(self) -> List[str]:
+        """記録のある日付を古い順に返す"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if os.path.isfile(os.path.join(self.directory, name, INDEX_FILE))
+        )
+
+    def segments_for_day(self, day: str) -> List[Dict[str, Any]]:
+        """日付の索引（セグメントの一覧）を読む（ない・壊れている場合は空）"""
+        try:
+            with open(os.path.join(self.directory, day, INDEX_FILE), 'r', encoding='utf-8') as f:
+                return list(json.load(f).get('segments') or [])
+        except (OSError, ValueError, AttributeError):
+            return []
+
+    def read(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """
+        取得時刻が start 以上 end 未満の記録を古い順に返す
+
+        書き込み前にためている記録は含まない（必要なら先に flush() を呼ぶ）。
+        """
+        first_day = partition_name(start) if start is not None else None
+        last_day = partition_name(end) if end is not None else None
+        for day in self.days():
+            if (first_day is not None and day < first_day) or (last_day is not None and day > last_day):
+                continue
+            segments = sorted(self.segments_for_day(day), key=lambda segment: segment['start'])
+            for segment in segments:
+                if (start is not None and segment['end'] < start) or (end is not None and segment['start'] >= end):
+                    continue
+                for record in self._read_segment(os.path.join(self.directory, day, segment['file'])):
+                    ts = record.get('ts', 0)
+                    if (start is None or ts >= start) and (end is None or ts < end):
+                        yield record
+
+    @staticmethod
+    def _read_segment(path: str) -> Iterator[Dict[str, Any]]:
+        """セグメントの記録を先頭から読む（書きかけの末尾は読み飛ばす）"""
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            return
+        except (EOFError, OSError, zlib.error):
+            print(f"アーカイブの末尾が壊れているため、途中までを読みました: {path}")
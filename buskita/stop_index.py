@@ -0,0 +1,161 @@
+"""
+バス停（とバス）の空間インデックス
+
+地点を緯度・経度の格子（グリッド）に振り分けておき、
+「地図の表示範囲にあるバス停・バス」を周辺のマスだけを見て答える。
+バス停一覧は辞書のバージョンが変わったときだけ取り直して作り直す。
+（バスに最も近いバス停は geo.GeofenceEngine でスナップショットごとにまとめて求める）
+"""
+
+import math
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+# 格子1マスの大きさ（度）。緯度方向でおよそ550m
+DEFAULT_CELL_DEG = 0.005
+
+
+def _first(item: Dict[str, Any], *keys):
+    """最初に見つかったキーの値を返す"""
+    for key in keys:
+        if item.get(key) is not None:
+            return item[key]
+    return None
+
+
+def normalize_stops(items: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    辞書の応答（ランドマーク辞書など）からバス停を {'id', 'name', 'lat', 'lng'} の形にそろえる
+
+    位置は 'position': {'latitude', 'longitude'}（ランドマーク辞書と同じ形）か、
+    'latitude' / 'longitude'、'lat' / 'lng' のいずれかから読む。位置のないものは使わない。
+    """
+    stops = []
+    seen = set()
+    for item in items or []:
+        position = item.get('position') or item
+        try:
+            lat = float(_first(position, 'latitude', 'lat'))
+            lng = float(_first(position, 'longitude', 'lng'))
+        except (TypeError, ValueError):
+            continue
+        stop_id = _first(item, 'bus_stop_no', 'busStopNo', 'busstopId', 'id')
+        name = _first(item, 'name', 'bus_stop_name', 'busStopName', 'group_name') or ''
+        if (stop_id, name, lat, lng) in seen:
+            continue
+        seen.add((stop_id, name, lat, lng))
+        stops.append({'id': stop_id, 'name': name, 'lat': lat, 'lng': lng})
+    return stops
+
+
+class GridIndex:
+    """地点（バス停・バス）を格子に振り分けた空間インデックス（作成後は変更しない）"""
+
+    def __init__(self, points: List[Dict[str, Any]], cell_deg: float = DEFAULT_CELL_DEG, version=None):
+        """
+        Args:
+            points (list): 'lat' と 'lng' を持つ地点のリスト（normalize_stops() の結果など）
+            cell_deg (float): 格子1マスの大きさ（度）
+            version: 作成に使ったデータのバージョン
+        """
+        self.points = points
+        self.cell_deg = cell_deg
+        self.version = version
+        self._cells: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for i, point in enumerate(points):
+            self._cells[self._cell(point['lat'], point['lng'])].append(i)
+        self._cells = dict(self._cells)
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        """地点が入るマスの番号"""
+        return math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg)
+
+    def within(self, south: float, west: float, north: float, east: float) -> List[Dict[str, Any]]:
+        """緯度・経度の範囲（地図の表示範囲）に入る地点を返す"""
+        i0, j0 = self._cell(south, west)
+        i1, j1 = self._cell(north, east)
+        results = []
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._cells):
+            # 範囲が広い場合はマスを総当たりせず、地点を直接見る
+            cells = self._cells.values()
+        else:
+            cells = (self._cells.get((i, j), ()) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1))
+        for indexes in cells:
+            for index in indexes:
+                point = self.points[index]
+                if south <= point['lat'] <= north and west <= point['lng'] <= east:
+                    results.append(point)
+        return results
+
+
+EMPTY_INDEX = GridIndex([])
+
+
+class StopIndexStore:
+    """バス停辞書のバージョンを確認し、変わったときだけインデックスを作り直す"""
+
+    def __init__(self,
+                 fetch_version: Callable[[], Any],
+                 fetch_stops: Callable[[], List[Dict[str, Any]]],
+                 check_interval: float = 60 * 60,
+                 retry_interval: float = 5 * 60):
+        """
+        Args:
+            fetch_version: 元にする辞書のバージョンを返す関数（変わったら作り直す）
+            fetch_stops: 位置を持つ生のバス停リストを返す関数
+            check_interval (float): バージョンを確認する間隔（秒）
+            retry_interval (float): 取得に失敗したときに再試行するまでの間隔（秒）
+        """
+        self.fetch_version = fetch_version
+        self.fetch_stops = fetch_stops
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self._index = EMPTY_INDEX
+        self._next_check = 0.0
+        self._checking = False
+        self._lock = threading.Lock()
+
+    def get(self) -> GridIndex:
+        """現在のインデックスを返す（確認の時刻を過ぎていれば裏でバージョンを確認する）"""
+        if time.monotonic() >= self._next_check:
+            self._check_in_background()
+        return self._index
+
+    def refresh_once(self) -> bool:
+        """
+        バージョンを確認し、変わっていればバス停を取り直して作り直す
+
+        Returns:
+            bool: 作り直した場合は True
+        """
+        version = self.fetch_version()
+        if version is not None and version == self._index.version:
+            return False
+        stops = normalize_stops(self.fetch_stops())
+        self._index = GridIndex(stops, version=version)
+        print(f"バス停インデックスを作成しました（バージョン {version}、{len(stops)}件）")
+        return True
+
+    def _check_in_background(self):
+        """別スレッドで確認を始める（待たない）"""
+        with self._lock:
+            if self._checking or time.monotonic() < self._next_check:
+                return
+            self._checking = True
+        threading.Thread(target=self._run_check, name='stop-index-refresh', daemon=True).start()
+
+    def _run_check(self):
+        """確認を1回行い、次に確認する時刻を決める"""
+        interval = self.check_interval
+        try:
+            self.refresh_once()
+        except Exception as e:
+            # 取得に失敗しても手持ちのインデックスを使い続ける
+            interval = self.retry_interval
+            print(f"バス停インデックスの更新エラー: {e}")
+        finally:
+            with self._lock:
+                self._next_check = time.monotonic() + interval
+                self._checking = False
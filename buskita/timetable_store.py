@@ -0,0 +1,126 @@
+"""
+時刻表データ（static/timetable.json）の読み込みとキャッシュ
+
+起動後に1回だけ読み込み、時刻表ページ用の「時間ごとのグループ化」と
+API用のJSONバイト列、次の便を探すための発車時刻インデックスを前もって作っておく。ファイルの更新時刻が
+変わったときだけ読み直すので、リクエストごとにJSONを解析することはない。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from departure_index import DepartureIndex
+
+
+def group_schedules_by_hour(schedules):
+    """
+    時刻オブジェクトのリストを時間ごとにグループ化する
+    [{'time': '07:30', 'is_direct': True}] -> [('7', ['30(直)'])]
+    """
+    grouped = {}
+    if not schedules:
+        return [] # 空のリストを返す
+    for schedule_item in schedules:
+        try:
+            time_str = schedule_item['time']
+            is_direct = schedule_item['is_direct']
+            hour, minute = time_str.split(':')
+            hour_key = str(int(hour))
+
+            if hour_key not in grouped:
+                grouped[hour_key] = []
+
+            display_minute = f"{minute}(直)" if is_direct else minute
+            grouped[hour_key].append(display_minute)
+
+        except (ValueError, KeyError):
+            continue
+
+    # 時間でソートしたタプルのリストを返す
+    return sorted(grouped.items(), key=lambda item: int(item[0]))
+
+
+@dataclass(frozen=True)
+class Timetable:
+    """前処理済みの時刻表（生成後は変更しない）"""
+    raw: Dict[str, Any] = field(default_factory=dict)
+    grouped: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    json_bytes: bytes = b'{}'
+    etag: str = ''
+    departures: DepartureIndex = field(default_factory=DepartureIndex)
+    mtime_ns: Optional[int] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.mtime_ns is not None
+
+
+def build_timetable(raw_bytes: bytes, mtime_ns: int) -> Timetable:
+    """ファイルの内容から前処理済みの時刻表を作る"""
+    raw = json.loads(raw_bytes)
+
+    grouped = {}
+    for route_id, data in raw.items():
+        processed_schedules = {}
+        for day, times in data.get('schedules', {}).items():
+            processed_schedules[day] = group_schedules_by_hour(times)
+
+        grouped[route_id] = {
+            'routeName': data['routeName'],
+            'schedules': processed_schedules
+        }
+
+    return Timetable(
+        raw=raw,
+        grouped=grouped,
+        json_bytes=json.dumps(raw, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+        etag=hashlib.sha1(raw_bytes).hexdigest(),
+        departures=DepartureIndex.from_timetable(raw),
+        mtime_ns=mtime_ns
+    )
+
+
+class TimetableStore:
+    """時刻表ファイルを監視し、変更されたときだけ読み直す"""
+
+    def __init__(self, path: str, check_interval: float = 1.0):
+        """
+        Args:
+            path (str): 時刻表JSONのパス
+            check_interval (float): ファイルの更新時刻を確認する最短間隔（秒）
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._timetable = Timetable()
+        self._last_check = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Timetable:
+        """最新の時刻表を返す（読み込みに失敗した場合は直前のもの、なければ空）"""
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self.check_interval:
+            return self._timetable
+
+        with self._lock:
+            if self._last_check is None or now - self._last_check >= self.check_interval:
+                self._last_check = now
+                self._reload_if_changed()
+        return self._timetable
+
+    def _reload_if_changed(self):
+        """更新時刻が変わっていれば読み直す"""
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+            if mtime_ns == self._timetable.mtime_ns:
+                return
+            with open(self.path, 'rb') as f:
+                raw_bytes = f.read()
+            self._timetable = build_timetable(raw_bytes, mtime_ns)
+            print(f"時刻表を読み込みました: {self.path}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading timetable: {e}")
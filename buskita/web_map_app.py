@@ -1,52 +1,148 @@
 import requests
-from flask import Flask, jsonify, render_template
+from flask import Flask, Response, jsonify, render_template, request
 from datetime import datetime
+import atexit
 import json
 import os
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+from backup_writer import BackupWriter
+from bus_snapshot import SnapshotPoller
+from buskita_client import BuskitaClient
+from departure_index import DAY_TYPES, JST
+from dictionary_cache import DictionaryCache
+from fetch_engine import BusFetchEngine, DetailCache
+from geo import GeofenceEngine
+from holiday_calendar import HolidayCalendar
+from metrics import CONTENT_TYPE, MultiProcessMetrics, counter, gauge, histogram
+from observation_rollup import DelayRollup, OccupancyRollup
+from observation_store import ObservationRecorder, ObservationStore
+from shared_snapshot import SharedSnapshotStore
+from stop_index import GridIndex, StopIndexStore
+from timetable_store import TimetableStore
 
 app = Flask(__name__)
 
 # --- グローバル定数 ---
-API_BASE_URL = "https://api.buskita.com"
 SITE_ID = 9
-BACKUP_FILE = 'archive/last_known_buses.json'
+BACKUP_FILE = os.environ.get('BACKUP_FILE', 'archive/last_known_buses.json')
+TIMETABLE_FILE = 'static/timetable.json'
+# バックアップを書き込む最短間隔（秒）。内容が変わっていなければ間隔を過ぎても書かない
+BACKUP_MIN_INTERVAL = float(os.environ.get('BACKUP_MIN_INTERVAL', '30'))
 HEADERS = {
     'Accept': 'application/json',
     'Content-Type': 'application/json',
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
 }
+# 上流APIを取得する間隔（秒）。閲覧者数に関係なくこの周期で1回だけ取得する
+BUS_POLL_INTERVAL = float(os.environ.get('BUS_POLL_INTERVAL', '3'))
+# get-bus を同時に呼ぶ数と、詳細取得全体の締め切り（秒）。締め切りに間に合わないバスは位置情報のみで返す
+BUS_DETAIL_CONCURRENCY = int(os.environ.get('BUS_DETAIL_CONCURRENCY', '10'))
+BUS_DETAIL_DEADLINE = float(os.environ.get('BUS_DETAIL_DEADLINE', '2.5'))
+# 詳細情報のキャッシュ有効期限（秒）と最大件数。期限内のバスは get-bus を呼ばない
+BUS_DETAIL_TTL = float(os.environ.get('BUS_DETAIL_TTL', '300'))
+BUS_DETAIL_CACHE_SIZE = int(os.environ.get('BUS_DETAIL_CACHE_SIZE', '500'))
+# 上流APIへの接続プール（get-buses・辞書・祝日など。get-bus は detail_client を使う）
+api_client = BuskitaClient(headers=HEADERS, pool_size=4)
+# 締め切り付きで呼ぶ get-bus 用。読み込みの再試行で締め切りを超えないよう、接続エラーだけを再試行する
+detail_client = BuskitaClient(headers=HEADERS, pool_size=BUS_DETAIL_CONCURRENCY, retry_reads=False)
+# 配信ストリーム（SSE）で変化がないときに送る keep-alive の間隔と、1本の接続を保つ最大時間（秒）
+BUS_STREAM_HEARTBEAT = float(os.environ.get('BUS_STREAM_HEARTBEAT', '15'))
+BUS_STREAM_MAX_DURATION = float(os.environ.get('BUS_STREAM_MAX_DURATION', '600'))
+# 1ワーカーで同時に保つ配信ストリームの上限。ストリームは1本ごとにスレッドを占有するので、
+# gthread のスレッド数（Dockerfile では 64）より小さくして、通常のリクエスト用のスレッドを残す
+BUS_STREAM_MAX_CLIENTS = int(os.environ.get('BUS_STREAM_MAX_CLIENTS', '48'))
+# gunicornの全ワーカーが共有するスナップショットとロックファイルの置き場所
+BUS_SNAPSHOT_DIR = os.environ.get('BUS_SNAPSHOT_DIR', tempfile.gettempdir())
+# 乗客数・遅延の観測を記録するディレクトリ（空にすると記録しない）と、まとめて書き込むしきい値
+OBSERVATION_DIR = os.environ.get('OBSERVATION_DIR', 'archive/observations')
+OBSERVATION_FLUSH_ROWS = int(os.environ.get('OBSERVATION_FLUSH_ROWS', '2000'))
+OBSERVATION_FLUSH_INTERVAL = float(os.environ.get('OBSERVATION_FLUSH_INTERVAL', '60'))
+# 記録した観測から集計を更新する間隔（秒）
+OBSERVATION_ROLLUP_INTERVAL = float(os.environ.get('OBSERVATION_ROLLUP_INTERVAL', '60'))
+
+# バスの最寄りバス停として表示する最大距離（km）
+NEAR_STOP_MAX_KM = float(os.environ.get('NEAR_STOP_MAX_KM', '0.3'))
+# 龍谷大学瀬田キャンパスのおおよその範囲（緯度, 経度）。この中にいるバスは atCampus を true にする
+CAMPUS_FENCE = [
+    (34.9668, 135.9364), (34.9668, 135.9428),
+    (34.9618, 135.9428), (34.9618, 135.9364)
+]
+# 各ワーカーが計測値をファイルに書き出す間隔（秒）。/metrics は全ワーカーの分を合算して返す
+METRICS_WRITE_INTERVAL = float(os.environ.get('METRICS_WRITE_INTERVAL', '5'))
+
+# --- 計測値（/metrics で Prometheus 形式で出力する） ---
+BACKUP_FALLBACKS = counter(
+    'buskita_backup_fallback_total',
+    '上流APIから取得できずバックアップファイルを使った回数（reason=error: 通信エラー, empty: 有効なデータなし）',
+    ['reason']
+)
+SERIALIZE_SECONDS = histogram(
+    'buskita_response_serialize_seconds', 'バス位置の応答・配信イベントをJSONにする時間', ['endpoint']
+)
 
 # --- 補助関数 ---
-def group_schedules_by_hour(schedules):
+# 静的な辞書（バス会社・ランドマーク・バス停など）は起動時にファイルから読み込み、
+# バージョンが変わったときだけ上流APIから取り直す
+dictionary_cache = DictionaryCache(api_client, site_id=SITE_ID)
+dictionary_cache.load_all()
+
+def get_busstops():
     """
-    時刻オブジェクトのリストを時間ごとにグループ化する
-    [{'time': '07:30', 'is_direct': True}] -> [('7', ['30(直)'])]
+    バス停の一覧を返す
+
+    バス停グループ・グルーピングの辞書には位置がないため、位置はランドマーク辞書の
+    'position' から取る。バス停グループと同じ名前のランドマークだけを使い、
+    1件もなければ（大学などの施設をバス停として出さないよう）空を返す。
     """
-    grouped = {}
-    if not schedules:
-        return [] # 空のリストを返す
-    for schedule_item in schedules:
-        try:
-            time_str = schedule_item['time']
-            is_direct = schedule_item['is_direct']
-            hour, minute = time_str.split(':')
-            hour_key = str(int(hour))
-
-            if hour_key not in grouped:
-                grouped[hour_key] = []
-            
-            display_minute = f"{minute}(直)" if is_direct else minute
-            grouped[hour_key].append(display_minute)
-
-        except (ValueError, KeyError):
-            continue
-    
-    # 時間でソートしたタプルのリストを返す
-    return sorted(grouped.items(), key=lambda item: int(item[0]))
+    landmarks = dictionary_cache.get('landmarks').get('landmarksDictionary') or []
+    groups = dictionary_cache.get('busstops_group').get('groups') or []
+    group_ids = {group['group_name']: group.get('id') for group in groups if group.get('group_name')}
+    # 名前が一致したものは、バス停グループのIDを付けて返す
+    stops = [dict(landmark, id=group_ids[landmark['name']]) for landmark in landmarks if landmark.get('name') in group_ids]
+    if landmarks and groups and not stops:
+        print("バス停グループと名前が一致するランドマークがないため、バス停の位置を使いません")
+    return stops
+
+# バス停の空間インデックス。ランドマーク辞書かバス停辞書のバージョンが変わったときだけ作り直す
+stop_index_store = StopIndexStore(
+    lambda: (dictionary_cache.version('ui'), dictionary_cache.version('busstops')),
+    get_busstops
+)
+
+def parse_bbox(value):
+    """
+    'west,south,east,north'（Leaflet の toBBoxString() の形式）を (south, west, north, east) にする
+
+    形式が正しくない場合は ValueError を送出する。
+    """
+    west, south, east, north = (float(v) for v in value.split(','))
+    if south > north or west > east:
+        raise ValueError(value)
+    return south, west, north, east
+
+# バス停（円）とキャンパス（多角形）のジオフェンス。バス停のインデックスが作り直されたときだけ作り直す
+_geofence = (None, GeofenceEngine(polygons={'campus': CAMPUS_FENCE}))
+
+def geofence_for(stop_index):
+    """バス停のインデックスに対応するジオフェンスを返す"""
+    global _geofence
+    index, engine = _geofence
+    if index is not stop_index:
+        engine = GeofenceEngine(stop_index.points, polygons={'campus': CAMPUS_FENCE}, default_radius_km=NEAR_STOP_MAX_KM)
+        _geofence = (stop_index, engine)
+    return engine
 
 def filter_and_format_buses(bus_list):
-    """バスのリストを受け取り、位置情報があるものだけを抽出・整形する"""
+    """
+    バスのリストを受け取り、位置情報があるものだけを抽出・整形する
+
+    最寄りのバス停とキャンパス内かどうかは、全バス × 全バス停・ジオフェンスを
+    スナップショットごとに1回の配列演算でまとめて判定する。
+    """
     locations = []
     if not bus_list:
         return locations
@@ -66,14 +162,25 @@ def filter_and_format_buses(bus_list):
                 })
             except (ValueError, TypeError):
                 continue
+
+    engine = geofence_for(stop_index_store.get())
+    result = engine.evaluate(locations)
+    at_campus = result.inside_polygons['campus']
+    for i, location in enumerate(locations):
+        # 最寄りのバス停（一定距離内にある場合のみ）
+        index, distance = result.nearest(i)
+        location['nearStop'] = engine.points[index]['name'] if index is not None and distance <= NEAR_STOP_MAX_KM else None
+        location['atCampus'] = bool(at_campus[i])
     return locations
 
-def get_bus_details(work_no):
-    """個別のバスの詳細情報を取得する"""
+def get_bus_details(work_no, timeout=None):
+    """個別のバスの詳細情報を取得する（timeout: 読み込みを待つ最大秒数。既定値より長くはしない）"""
     try:
-        endpoint = f"{API_BASE_URL}/get-bus"
         payload = {"language": 1, "workNo": str(work_no), "siteId": SITE_ID}
-        response = requests.post(endpoint, json=payload, headers=HEADERS, timeout=3)
+        connect_timeout, read_timeout = detail_client.timeout_for('get-bus')
+        if timeout is not None:
+            read_timeout = min(read_timeout, timeout)
+        response = detail_client.post('get-bus', payload, timeout=(connect_timeout, read_timeout))
         if response.status_code == 200:
             buses = response.json().get('bus', [])
             if buses:
@@ -82,118 +189,470 @@ def get_bus_details(work_no):
         print(f"Error fetching details for workNo {work_no}: {e}")
     return None
 
+def get_bus_list():
+    """運行中の全バスの位置情報を取得する（失敗時は例外を送出）"""
+    payload = {"language": 1, "siteId": SITE_ID}
+    return api_client.post_json('get-buses', payload).get('buses', [])
+
+bus_fetch_engine = BusFetchEngine(
+    get_bus_list,
+    get_bus_details,
+    concurrency=BUS_DETAIL_CONCURRENCY,
+    deadline=BUS_DETAIL_DEADLINE,
+    detail_cache=DetailCache(ttl=BUS_DETAIL_TTL, max_size=BUS_DETAIL_CACHE_SIZE)
+)
+
+backup_writer = BackupWriter(BACKUP_FILE, min_interval=BACKUP_MIN_INTERVAL)
+
 def get_live_bus_data():
-    """運行中の全バスの位置情報と詳細情報を取得する"""
-    try:
-        # 1. 全バスの位置情報を取得
-        endpoint = f"{API_BASE_URL}/get-buses"
-        payload = {"language": 1, "siteId": SITE_ID}
-        response = requests.post(endpoint, json=payload, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        
-        buses_with_location = response.json().get('buses', [])
-        if not buses_with_location:
-            return []
-
-        # 2. 各バスの詳細情報を並行して取得
-        detailed_buses = {}
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_work_no = {executor.submit(get_bus_details, bus.get('workNo')): bus.get('workNo') for bus in buses_with_location}
-            
-            for future in future_to_work_no:
-                work_no = future_to_work_no[future]
-                detail = future.result()
-                if detail:
-                    detailed_buses[work_no] = detail
-        
-        # 3. 位置情報と詳細情報をマージ
-        merged_buses = []
-        for bus in buses_with_location:
-            work_no = bus.get('workNo')
-            if work_no in detailed_buses:
-                bus.update(detailed_buses[work_no])
-            merged_buses.append(bus)
-
-        if merged_buses:
-            os.makedirs(os.path.dirname(BACKUP_FILE), exist_ok=True)
-            with open(BACKUP_FILE, 'w', encoding='utf-8') as f:
-                json.dump(merged_buses, f, ensure_ascii=False, indent=2)
-        
-        return merged_buses
-        
-    except requests.exceptions.RequestException as e:
-        print(f"APIリクエストエラー (get-buses): {e}")
-        # APIが不調の場合、バックアップから読み込む
-        if os.path.exists(BACKUP_FILE):
-            print("バックアップからデータを読み込みます。")
-            with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return []
+    """
+    運行中の全バスの位置情報と詳細情報を取得する
 
-# --- Flask ルート定義 ---
+    上流APIが不調な場合は requests.exceptions.RequestException をそのまま送出する
+    （バックアップへの切り替えは fetch_bus_snapshot_data が行う）。
+    """
+    # 全バスの位置情報を取得し、キャッシュにないバスの詳細情報を締め切り付きで並行取得してマージする
+    merged_buses = bus_fetch_engine.fetch()
 
-@app.route('/')
-def index():
-    """メインのマップページ"""
-    return render_template('index.html')
+    if merged_buses:
+        backup_writer.write(merged_buses)
 
-@app.route('/api/bus_locations')
-def api_bus_locations():
-    """バスの位置情報を返すAPI"""
-    locations_raw = get_live_bus_data()
+    return merged_buses
+
+def fetch_bus_snapshot_data():
+    """上流APIからバス情報を取得する。取得できない場合はバックアップを使う（is_stale=True）"""
     is_stale = False # APIからのデータが古い場合にTrueになるフラグ
+    try:
+        locations_raw = get_live_bus_data()
+        fallback_reason = None if locations_raw else 'empty'
+    except requests.exceptions.RequestException as e:
+        print(f"APIリクエストエラー (get-buses): {e}")
+        locations_raw = []
+        fallback_reason = 'error'
 
     # APIからのデータ取得に失敗した場合
-    if not locations_raw:
+    if fallback_reason is not None:
         print(f"[{datetime.now()}] APIから有効なデータが取得できませんでした。バックアップを試みます。")
         if os.path.exists(BACKUP_FILE):
             try:
                 with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
                     locations_raw = json.load(f)
                 is_stale = True
+                BACKUP_FALLBACKS.inc(reason=fallback_reason)
                 print(f"[{datetime.now()}] バックアップファイルを使用しました。")
             except (json.JSONDecodeError, IOError) as e:
                 print(f"バックアップファイルの読み込みに失敗しました: {e}")
                 locations_raw = [] # バックアップも失敗した場合は空リスト
         else:
             print(f"[{datetime.now()}] バックアップファイルが見つかりませんでした。")
+    else:
+        print(f"[{datetime.now()}] APIから {len(locations_raw)} 台のバス情報を取得しました。")
 
-    # フィルタリングと整形
-    locations = filter_and_format_buses(locations_raw)
-    
-    if not is_stale:
-        print(f"[{datetime.now()}] APIから {len(locations)} 台の有効なバス情報を取得しました。")
+    return locations_raw, is_stale
 
-    return jsonify({
-        'buses': locations,
-        'is_stale': is_stale
+# 混雑分析用に、取得のたびに各バスの乗客数・定員・混雑度・遅延を記録する
+observation_store = ObservationStore(OBSERVATION_DIR) if OBSERVATION_DIR else None
+observation_recorder = None
+if observation_store is not None:
+    observation_recorder = ObservationRecorder(
+        observation_store,
+        max_rows=OBSERVATION_FLUSH_ROWS,
+        max_interval=OBSERVATION_FLUSH_INTERVAL
+    )
+    atexit.register(observation_recorder.flush)
+
+def record_observations(snapshot):
+    """上流APIから取れたデータだけを記録する（バックアップを読んだ回は記録しない）"""
+    if observation_recorder is not None and not snapshot.is_stale:
+        observation_recorder.record(snapshot.raw_buses, snapshot.fetched_at)
+
+# 全リクエストで共有するスナップショット（最初のリクエスト時に更新スレッドを起動する）
+# 上流APIの取得とバックアップファイルの書き込みは、ロックを取れた1ワーカーだけが行う
+bus_poller = SnapshotPoller(
+    fetch_bus_snapshot_data,
+    filter_and_format_buses,
+    interval=BUS_POLL_INTERVAL,
+    shared_store=SharedSnapshotStore(BUS_SNAPSHOT_DIR, f"buskita_snapshot_site{SITE_ID}"),
+    on_fetch=record_observations
+)
+
+def snapshot_age():
+    """配信中のスナップショットを上流から取得してからの経過秒数（まだなければ出力しない）"""
+    snapshot = bus_poller.latest
+    return time.time() - snapshot.fetched_at if snapshot.version else None
+
+gauge('buskita_snapshot_age_seconds', '配信中のスナップショットを上流から取得してからの経過時間', func=snapshot_age)
+gauge('buskita_snapshot_stale', '配信中のスナップショットがバックアップから読んだものなら 1',
+      func=lambda: float(bus_poller.latest.is_stale) if bus_poller.latest.version else None)
+gauge('buskita_snapshot_buses', '配信中のスナップショットのバスの台数', func=lambda: len(bus_poller.latest.buses))
+# 詳細情報キャッシュは取得担当のワーカーだけが埋めるので、動いているワーカーの最大値を出す
+gauge('buskita_detail_cache_entries', '詳細情報キャッシュの件数', func=lambda: len(bus_fetch_engine.detail_cache),
+      multiprocess_mode='max')
+
+# 各ワーカーの計測値をスナップショットと同じディレクトリに書き出し、/metrics で合算する
+multiprocess_metrics = MultiProcessMetrics(
+    os.path.join(BUS_SNAPSHOT_DIR, f"buskita_metrics_site{SITE_ID}"),
+    interval=METRICS_WRITE_INTERVAL
+)
+multiprocess_metrics.start()
+
+# 最新スナップショットのバス位置の空間インデックス（版が変わったときだけ作り直す）
+_bus_index = GridIndex([], version=None)
+
+def bus_index_for(snapshot):
+    """スナップショットのバスを格子に振り分けたインデックスを返す"""
+    global _bus_index
+    index = _bus_index
+    if index.version != snapshot.version:
+        index = GridIndex(snapshot.buses, version=snapshot.version)
+        _bus_index = index
+    return index
+
+def parse_bus_filter(args):
+    """
+    ?bbox=west,south,east,north と ?route=<行き先の一部> を読み取る
+
+    Returns:
+        tuple: (bbox または None, route または None)。bbox の形式が正しくない場合は ValueError
+    """
+    bbox = args.get('bbox')
+    return (parse_bbox(bbox) if bbox else None), (args.get('route') or None)
+
+def filter_buses(snapshot, bbox=None, route=None):
+    """表示範囲（bbox）と行き先（route を含むもの）でバスを絞り込む"""
+    if bbox is None and route is None:
+        return snapshot.buses
+    buses = bus_index_for(snapshot).within(*bbox) if bbox else snapshot.buses
+    if route:
+        buses = [bus for bus in buses if route in (bus.get('dest') or '')]
+    return buses
+
+def not_modified_response(etag):
+    """本文なしの304レスポンスを作る"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def get_holidays():
+    """祝日一覧（会社名 → 祝日リスト）を取得する（失敗時は例外を送出）"""
+    payload = {"language": 1, "siteId": SITE_ID}
+    return api_client.post_json('get-holidays', payload).get('holidays', {})
+
+# 曜日区分の判定は前もって作った表を引くだけ。祝日一覧は辞書と同じ場所に保存し、1日1回取り直す
+holiday_calendar = HolidayCalendar(
+    get_holidays,
+    cache_file=os.path.join(dictionary_cache.cache_dir, f"site{SITE_ID}_holidays.json")
+)
+
+# 遅延（路線 × 曜日区分 × 時）と乗車率（路線 × 曜日 × 15分枠）の集計。新しい観測だけをバックグラウンドで読み足す
+delay_rollup = None
+occupancy_rollup = None
+if observation_store is not None:
+    delay_rollup = DelayRollup(observation_store, holiday_calendar.day_type, refresh_interval=OBSERVATION_ROLLUP_INTERVAL)
+    occupancy_rollup = OccupancyRollup(observation_store, holiday_calendar.day_type, refresh_interval=OBSERVATION_ROLLUP_INTERVAL)
+
+# ダッシュボードの方向（timetable.json のキー）→ その方向の便とみなす路線名（行き先）に含まれる文字列
+CONGESTION_DIRECTION_KEYWORDS = {
+    'seta_to_univ': '龍谷大学',
+    'univ_to_seta': '瀬田駅行き'
+}
+CONGESTION_LEVEL_ORDER = ('normal', 'busy', 'crowded')
+
+# 時刻表は起動後に1回だけ読み込み、ファイルが更新されたときだけ読み直す
+timetable_store = TimetableStore(TIMETABLE_FILE)
+timetable_store.get()
+
+# --- Flask ルート定義 ---
+
+@app.route('/')
+def index():
+    """メインのマップページ"""
+    return render_template('index.html')
+
+@app.route('/api/bus_locations')
+def api_bus_locations():
+    """
+    バスの位置情報を返すAPI（バックグラウンドで更新済みのスナップショットを返すだけ）
+
+    ?bbox=west,south,east,north で地図の表示範囲に入るバスだけを、
+    ?route=<行き先の一部> でその行き先のバスだけを返す。
+    """
+    try:
+        bbox, route = parse_bus_filter(request.args)
+    except ValueError:
+        return jsonify({'error': 'bbox は west,south,east,north の形式で指定してください'}), 400
+    snapshot = bus_poller.get_snapshot()
+
+    # 同じURLなら版番号が同じ間は内容も同じなので、If-None-Match が一致すれば本文なしの304を返す
+    etag = f"v{snapshot.version}"
+    if etag in request.if_none_match:
+        return not_modified_response(etag)
+
+    buses = filter_buses(snapshot, bbox, route)
+    with SERIALIZE_SECONDS.time(endpoint='bus_locations'):
+        response = jsonify({
+            'buses': buses,
+            'is_stale': snapshot.is_stale,
+            'version': snapshot.version
+        })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/bus_locations/delta')
+def api_bus_locations_delta():
+    """
+    前回取得したバージョンからの差分だけを返すAPI
+
+    ?since=<version> を付けると、変化したバス（changed）と消えたバスのID（removed）だけを返す。
+    変化がなければ unchanged: true のみ。since がない・古すぎる場合は全件（full: true）を返す。
+    """
+    snapshot = bus_poller.get_snapshot()
+    since = request.args.get('since', type=int)
+
+    if since is not None:
+        diff = bus_poller.history.diff_since(since)
+        if diff is not None:
+            with SERIALIZE_SECONDS.time(endpoint='bus_locations_delta'):
+                return jsonify(diff)
+
+    with SERIALIZE_SECONDS.time(endpoint='bus_locations_delta'):
+        return jsonify({
+            'version': snapshot.version,
+            'full': True,
+            'buses': snapshot.buses,
+            'is_stale': snapshot.is_stale
+        })
+
+@lru_cache(maxsize=64)
+def encode_stream_event(since, version):
+    """
+    配信ストリームで送る1件分のイベントを作る
+
+    同じ (基準バージョン, 最新バージョン) の組み合わせは1回だけ組み立て、
+    接続中の全クライアントに同じバイト列を送る。
+    """
+    diff = bus_poller.history.diff_since(since) if since is not None else None
+    if diff is None or diff['version'] != version:
+        snapshot = bus_poller.get_snapshot()
+        diff = {
+            'version': snapshot.version,
+            'full': True,
+            'buses': snapshot.buses,
+            'is_stale': snapshot.is_stale
+        }
+    with SERIALIZE_SECONDS.time(endpoint='bus_stream'):
+        data = json.dumps(diff, ensure_ascii=False, separators=(',', ':'))
+    return f"id: {diff['version']}\ndata: {data}\n\n"
+
+# 配信ストリームの同時接続数の枠
+stream_slots = threading.BoundedSemaphore(BUS_STREAM_MAX_CLIENTS)
+
+@app.route('/api/bus_stream')
+def api_bus_stream():
+    """
+    バス位置情報の配信ストリーム（Server-Sent Events）
+
+    スナップショットが更新されるたびに、前回送った版からの差分を1件のイベントとして送る。
+    再接続時はブラウザが送る Last-Event-ID（または ?since=）から続きを送る。
+    ストリームを維持できないクライアントは /api/bus_locations/delta のポーリングを使う。
+
+    ?bbox= / ?route= を付けると、その範囲・行き先のバスだけを送る。この場合は接続ごとに
+    前回送ったバスとの差分を送り、範囲から出たバスは removed として送る（最初の1件は全件）。
+    """
+    try:
+        bbox, route = parse_bus_filter(request.args)
+    except ValueError:
+        return jsonify({'error': 'bbox は west,south,east,north の形式で指定してください'}), 400
+
+    if not stream_slots.acquire(blocking=False):
+        # 上限に達したら断り、ブラウザ側はポーリング（/api/bus_locations/delta）に切り替える
+        response = jsonify({'error': '配信ストリームが混み合っています。ポーリングをご利用ください'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '60'
+        return response
+
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+
+    def generate(version):
+        deadline = time.monotonic() + BUS_STREAM_MAX_DURATION
+        # 切断時はブラウザが3秒後に自動で再接続する
+        yield "retry: 3000\n\n"
+        while time.monotonic() < deadline:
+            snapshot = bus_poller.wait_for_change(version, timeout=BUS_STREAM_HEARTBEAT)
+            if snapshot.version == version:
+                yield ": keep-alive\n\n"
+                continue
+            yield encode_stream_event(version, snapshot.version)
+            version = snapshot.version
+
+    def generate_filtered():
+        deadline = time.monotonic() + BUS_STREAM_MAX_DURATION
+        yield "retry: 3000\n\n"
+        version = None
+        sent = None
+        while time.monotonic() < deadline:
+            snapshot = bus_poller.wait_for_change(version, timeout=BUS_STREAM_HEARTBEAT)
+            if snapshot.version == version:
+                yield ": keep-alive\n\n"
+                continue
+            buses = {bus['id']: bus for bus in filter_buses(snapshot, bbox, route)}
+            if sent is None:
+                event = {'version': snapshot.version, 'full': True, 'buses': list(buses.values()), 'is_stale': snapshot.is_stale}
+            else:
+                changed = [bus for bus_id, bus in buses.items() if sent.get(bus_id) != bus]
+                removed = [bus_id for bus_id in sent if bus_id not in buses]
+                event = {
+                    'version': snapshot.version,
+                    'unchanged': False,
+                    'changed': changed,
+                    'removed': removed,
+                    'is_stale': snapshot.is_stale
+                }
+            sent = buses
+            version = snapshot.version
+            if not event.get('full') and not event['changed'] and not event['removed']:
+                # 範囲内のバスに変化がなければ何も送らない
+                yield ": keep-alive\n\n"
+                continue
+            with SERIALIZE_SECONDS.time(endpoint='bus_stream'):
+                data = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+            yield f"id: {version}\ndata: {data}\n\n"
+
+    stream = generate_filtered() if bbox or route else generate(since)
+    response = Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # リバースプロキシでバッファリングさせない
     })
+    # 切断・打ち切りのどちらでも、WSGIサーバーが応答を閉じたときに枠を返す
+    response.call_on_close(stream_slots.release)
+    return response
 
 @app.route('/timetable')
 def timetable_page():
-    """時刻表ページを表示する"""
-    try:
-        with open('static/timetable.json', 'r', encoding='utf-8') as f:
-            raw_timetable_data = json.load(f)
-
-        timetable_data = {}
-        for route_id, data in raw_timetable_data.items():
-            processed_schedules = {}
-            for day, times in data.get('schedules', {}).items():
-                processed_schedules[day] = group_schedules_by_hour(times)
-            
-            timetable_data[route_id] = {
-                'routeName': data['routeName'],
-                'schedules': processed_schedules
-            }
-            
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"Error loading timetable: {e}")
-        timetable_data = {}
-        
+    """時刻表ページを表示する（時間ごとのグループ化は読み込み時に済ませてある）"""
+    timetable_data = timetable_store.get().grouped
     return render_template('timetable.html', timetable_data=timetable_data)
 
 
+@app.route('/api/next_departures')
+def api_next_departures():
+    """
+    各路線の次の便・その次の便・最終便を返すAPI
+
+    ?day_type=weekdays|saturdays|holidays で曜日区分を、?at=HH:MM で基準時刻を指定できる
+    （省略時は祝日を考慮した今日の区分と、日本時間の現在時刻）。
+    """
+    now = datetime.now(JST)
+    at = request.args.get('at')
+    if at:
+        try:
+            at_time = datetime.strptime(at, '%H:%M')
+        except ValueError:
+            return jsonify({'error': 'at は HH:MM 形式で指定してください'}), 400
+        now = now.replace(hour=at_time.hour, minute=at_time.minute, second=0, microsecond=0)
+
+    day_type = request.args.get('day_type') or holiday_calendar.day_type(now)
+    if day_type not in DAY_TYPES:
+        return jsonify({'error': f"day_type は {', '.join(DAY_TYPES)} のいずれかです"}), 400
+
+    timetable = timetable_store.get()
+    routes = {}
+    for route_id, data in timetable.raw.items():
+        routes[route_id] = dict(timetable.departures.lookup(route_id, day_type, now), routeName=data.get('routeName'))
+
+    return jsonify({
+        'day_type': day_type,
+        'server_time': int(now.timestamp()),
+        'routes': routes
+    })
+
+@app.route('/api/delay_stats')
+def api_delay_stats():
+    """
+    記録した遅延の集計（路線 × 曜日区分 × 時ごとの件数・平均・中央値・90パーセンタイル）を返すAPI
+
+    ?route=<行き先>、?day_type=weekdays|saturdays|holidays、?hour=0〜23 で絞り込める。
+    集計は前もって済ませてあり、ここでは結果を選ぶだけ。
+    """
+    if delay_rollup is None:
+        return jsonify({'error': '観測の記録が無効になっています'}), 404
+
+    day_type = request.args.get('day_type')
+    if day_type is not None and day_type not in DAY_TYPES:
+        return jsonify({'error': f"day_type は {', '.join(DAY_TYPES)} のいずれかです"}), 400
+    hour = request.args.get('hour', type=int)
+
+    return jsonify({
+        'updated_at': int(delay_rollup.updated_at),
+        'stats': delay_rollup.query(route=request.args.get('route'), day_type=day_type, hour=hour)
+    })
+
+@app.route('/api/congestion_forecast')
+def api_congestion_forecast():
+    """
+    記録した乗客数から求めた、曜日・15分枠ごとの混雑予報を返すAPI
+
+    ?weekday=0〜6（月曜=0、祝日は6）と ?at=HH:MM で枠を指定できる（省略時は日本時間の現在）。
+    routes は路線ごとの乗車率（%）の集計と混雑度、directions はダッシュボードの方向ごとに
+    最も混む路線の混雑度。集計は前もって済ませてあり、ここでは表を引くだけ。
+    """
+    if occupancy_rollup is None:
+        return jsonify({'error': '観測の記録が無効になっています'}), 404
+
+    now = datetime.now(JST)
+    at = request.args.get('at')
+    if at:
+        try:
+            at_time = datetime.strptime(at, '%H:%M')
+        except ValueError:
+            return jsonify({'error': 'at は HH:MM 形式で指定してください'}), 400
+        now = now.replace(hour=at_time.hour, minute=at_time.minute, second=0, microsecond=0)
+
+    weekday = request.args.get('weekday', type=int)
+    if weekday is None:
+        weekday = OccupancyRollup.weekday_for(now.date(), holiday_calendar.day_type(now))
+    elif not 0 <= weekday <= 6:
+        return jsonify({'error': 'weekday は 0〜6 で指定してください'}), 400
+
+    slot = (now.hour * 3600 + now.minute * 60) // OccupancyRollup.SLOT_SECONDS
+    routes = occupancy_rollup.forecast(weekday, slot)
+
+    directions = {}
+    for direction, keyword in CONGESTION_DIRECTION_KEYWORDS.items():
+        levels = [entry['level'] for entry in routes if entry['level'] and keyword in entry['route']]
+        directions[direction] = max(levels, key=CONGESTION_LEVEL_ORDER.index) if levels else None
+
+    return jsonify({
+        'weekday': weekday,
+        'slot_start': f"{slot * 15 // 60:02d}:{slot * 15 % 60:02d}",
+        'updated_at': int(occupancy_rollup.updated_at),
+        'directions': directions,
+        'routes': routes
+    })
+
+@app.route('/api/stops')
+def api_stops():
+    """
+    バス停を返すAPI
+
+    ?bbox=west,south,east,north を付けると、地図の表示範囲に入るバス停だけを返す。
+    """
+    stop_index = stop_index_store.get()
+    bbox = request.args.get('bbox')
+    if bbox:
+        try:
+            stops = stop_index.within(*parse_bbox(bbox))
+        except ValueError:
+            return jsonify({'error': 'bbox は west,south,east,north の形式で指定してください'}), 400
+    else:
+        stops = stop_index.points
+
+    return jsonify({'version': stop_index.version, 'stops': stops})
+
 @app.route('/api/landmarks')
 def api_landmarks():
     """固定のランドマーク情報を返す"""
@@ -215,14 +674,18 @@ def api_landmarks():
 
 @app.route('/api/timetable_data')
 def api_timetable_data():
-    """静的な時刻表JSONをそのまま返す"""
-    try:
-        with open('static/timetable.json', 'r', encoding='utf-8') as f:
-            timetable_data = json.load(f)
-        return jsonify(timetable_data)
-    except Exception as e:
-        print(f"Error serving timetable json: {e}")
+    """静的な時刻表JSONをそのまま返す（ファイル内容のハッシュをETagにする）"""
+    timetable = timetable_store.get()
+    if not timetable.is_loaded:
         return jsonify({}), 500
+    if timetable.etag in request.if_none_match:
+        return not_modified_response(timetable.etag)
+
+    # 読み込み時にシリアライズ済みのバイト列をそのまま返す
+    response = Response(timetable.json_bytes, mimetype='application/json')
+    response.set_etag(timetable.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/network_test')
 def api_network_test():
@@ -254,5 +717,10 @@ def api_network_test():
         'vpn_detected': not any(result['accessible'] for result in results.values())
     })
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """計測値を Prometheus のテキスト形式で返す（全ワーカーの値を合算したもの）"""
+    return Response(multiprocess_metrics.render(), mimetype=None, content_type=CONTENT_TYPE)
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file